@@ -0,0 +1,372 @@
+"""Benchmark how matrix creation and `smatrix ps` scale with the size of the matrix
+
+Each size gets a synthetic config with symlinks, templated copies and extra
+scripts, which is created with `smatrix create --start`. `smatrix ps` is then
+run against canned sacct output. `sbatch`, `sacct` and `scontrol` are stubs put
+at the front of PATH, so no cluster is needed.
+
+Every command is run in its own process, and its wall time, peak RSS, the
+number of files it created and (if strace is installed) the number of syscalls
+it made are reported, in total and per instance.
+
+    $ python benchmarks/bench.py --sizes 10,1000,100000 --jobs 8
+    $ python benchmarks/bench.py --output new.json --compare old.json
+
+With --compare, the exit status is 1 if any measurement got worse by more than
+--tolerance, so that this can be run before changes go anywhere near a cluster.
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000]
+
+# the second axis always has this many values; the first makes up the rest
+INNER_AXIS_SIZE = 10
+
+# measurements which are compared against a baseline, and how much each has to
+# grow by in absolute terms as well, so that noise in tiny numbers isn't flagged
+COMPARED = {
+    "wall_s": 0.05,
+    "max_rss_kb": 1024,
+    "files": 0,
+    "syscalls": 100,
+}
+
+CONFIG = """
+[general]
+name = "bench"
+params = "#SBATCH --time=1:00"
+concurrent = 0
+root_label = "matrix_{size}"
+store = "{store}"
+layout = "{layout}"
+
+[matrix]
+seed = {seeds}
+model = [{models}]
+
+[symlinks]
+"reference.txt" = "{data}/reference.txt"
+"inputs/" = "{data}/input_$model_id.txt"
+
+[copies]
+"params.txt" = {{path = "{data}/params.txt", template = true}}
+"static.txt" = {{path = "{data}/static.txt"}}
+
+[script]
+slurm_exec = \"\"\"
+#!/bin/bash
+cat params.txt
+\"\"\"
+"helpers/analyse.py" = "print('analysing')"
+"helpers/plot.py" = "print('plotting')"
+"""
+
+# sbatch hands out increasing job ids; sacct replays whatever JSON the harness
+# has most recently written; scontrol fails, so everything is one array
+STUBS = {
+    "sbatch": """#!/bin/sh
+n=$(cat "$BENCH_DIR/next_job_id" 2>/dev/null || echo 1000)
+echo $((n + 1)) > "$BENCH_DIR/next_job_id"
+echo "Submitted batch job $n"
+""",
+    "sacct": """#!/bin/sh
+cat "$BENCH_DIR/sacct.json"
+""",
+    "scontrol": """#!/bin/sh
+exit 1
+""",
+}
+
+
+def write_stubs(bench_dir):
+    bin_dir = bench_dir / "bin"
+    os.makedirs(bin_dir, exist_ok=True)
+    for name, contents in STUBS.items():
+        path = bin_dir / name
+        path.write_text(contents)
+        path.chmod(0o755)
+    return bin_dir
+
+
+def write_data(bench_dir):
+    data_dir = bench_dir / "data"
+    os.makedirs(data_dir, exist_ok=True)
+    (data_dir / "reference.txt").write_text("ACGT" * 1024)
+    (data_dir / "static.txt").write_text("static\n" * 256)
+    (data_dir / "params.txt").write_text("seed=$seed\nmodel=$model_label\n")
+    for i in range(INNER_AXIS_SIZE):
+        (data_dir / f"input_{i}.txt").write_text(f"input {i}\n")
+    return data_dir
+
+
+def write_config(bench_dir, data_dir, size, store, layout):
+    seeds = max(1, size // INNER_AXIS_SIZE)
+    models = min(size, INNER_AXIS_SIZE)
+    contents = CONFIG.format(
+        size=size,
+        store=store,
+        layout=layout,
+        data=data_dir,
+        seeds=f"[{', '.join(str(i) for i in range(seeds))}]",
+        models=", ".join(f'{{label="m{i}", id="{i}"}}' for i in range(models)),
+    )
+    if layout == "packed":
+        # the packed layout has nowhere to put files until each job runs
+        contents = re.sub(r"\[symlinks\].*?(?=\[script\])", "", contents, flags=re.S)
+
+    path = bench_dir / f"bench_{size}.toml"
+    path.write_text(contents)
+    return path, seeds * models
+
+
+def write_sacct(bench_dir, job_id, count):
+    """Canned sacct output: mostly finished tasks, a few running, the rest pending"""
+    finished = int(count * 0.9)
+    running = min(count - finished, max(1, count // 20))
+
+    def record(task_id, state, set=True):
+        return {
+            "job_id": job_id + 1 + task_id,
+            "array": {
+                "job_id": job_id,
+                "task_id": {"set": set, "number": task_id if set else 0},
+            },
+            "state": {"current": [state]},
+            "time": {"start": 1700000000 + task_id},
+        }
+
+    jobs = []
+    for task_id in range(finished):
+        jobs.append(record(task_id, "FAILED" if task_id % 7 == 3 else "COMPLETED"))
+    for task_id in range(finished, finished + running):
+        jobs.append(record(task_id, "RUNNING"))
+    if finished + running < count:
+        jobs.append(record(0, "PENDING", set=False))
+
+    with open(bench_dir / "sacct.json", "w") as f:
+        json.dump({"jobs": jobs}, f)
+
+
+def smatrix_command(*args):
+    code = "import sys; sys.argv[0] = 'smatrix'; from smatrix.main import main; main()"
+    return [sys.executable, "-c", code, *args]
+
+
+def measure(command, cwd, env, strace):
+    """Run `command`, returning its wall time, peak RSS and syscall count"""
+    trace_file = None
+    if strace:
+        trace_file = Path(cwd) / "strace.txt"
+        command = ["strace", "-f", "-c", "-o", str(trace_file), *command]
+
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        command,
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    # wait4 gives the resource usage of this process alone, rather than the
+    # maximum over every child so far
+    stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    process.returncode = (
+        os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    )
+
+    if process.returncode != 0:
+        sys.stderr.write(stderr.decode(errors="replace"))
+        raise RuntimeError(f"'{' '.join(command)}' failed with {process.returncode}")
+
+    result = {"wall_s": round(wall, 3), "max_rss_kb": usage.ru_maxrss}
+    if trace_file:
+        result["syscalls"] = count_syscalls(trace_file)
+        os.remove(trace_file)
+    return result
+
+
+def count_syscalls(trace_file):
+    # the last line of `strace -c` is the total, e.g.
+    # "100.00    0.012345           1     12345       123 total"
+    for line in reversed(trace_file.read_text().splitlines()):
+        fields = line.split()
+        if fields and fields[-1] == "total":
+            return int(fields[3])
+    return None
+
+
+def count_files(path):
+    count = 0
+    for _, dirs, files in os.walk(path):
+        # symlinks to directories are listed in dirs, and aren't followed
+        count += len(dirs) + len(files)
+    return count
+
+
+def bench_size(bench_dir, data_dir, size, args, env):
+    config_path, count = write_config(bench_dir, data_dir, size, args.store, args.layout)
+    root = bench_dir / f"matrix_{size}"
+    shutil.rmtree(root, ignore_errors=True)
+
+    results = {"size": count}
+
+    create = measure(
+        smatrix_command("create", str(config_path), "--start", "--jobs", str(args.jobs)),
+        bench_dir,
+        env,
+        args.strace,
+    )
+    create["files"] = count_files(root)
+    results["create"] = create
+
+    job_id = int((root / "job_id").read_text().split()[0])
+    write_sacct(bench_dir, job_id, count)
+    results["ps"] = measure(
+        smatrix_command("ps", "--matrix-path", str(root)), bench_dir, env, args.strace
+    )
+
+    if not args.keep:
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def print_results(all_results):
+    header = f"{'command':<8} {'instances':>10} {'wall (s)':>10} {'rss (MB)':>10} {'files':>10} {'syscalls':>10} {'us/inst':>10} {'files/inst':>10} {'calls/inst':>10}"
+    print(header)
+    print("-" * len(header))
+
+    for results in all_results:
+        size = results["size"]
+        for name in ("create", "ps"):
+            r = results[name]
+            files = r.get("files")
+            syscalls = r.get("syscalls")
+            print(
+                f"{name:<8} {size:>10} {r['wall_s']:>10.3f} {r['max_rss_kb'] / 1024:>10.1f}"
+                f" {files if files is not None else '-':>10}"
+                f" {syscalls if syscalls is not None else '-':>10}"
+                f" {r['wall_s'] * 1e6 / size:>10.1f}"
+                f" {f'{files / size:.1f}' if files is not None else '-':>10}"
+                f" {f'{syscalls / size:.1f}' if syscalls is not None else '-':>10}"
+            )
+
+
+def compare(all_results, baseline, tolerance):
+    """Print every measurement which is worse than the baseline, and return how many there are"""
+    old = {results["size"]: results for results in baseline}
+    regressions = 0
+
+    for results in all_results:
+        previous = old.get(results["size"])
+        if previous is None:
+            continue
+
+        for name in ("create", "ps"):
+            for key, min_change in COMPARED.items():
+                new_value = results[name].get(key)
+                old_value = previous.get(name, {}).get(key)
+                if new_value is None or old_value is None:
+                    continue
+
+                if (
+                    new_value > old_value * (1 + tolerance)
+                    and new_value - old_value > min_change
+                ):
+                    regressions += 1
+                    print(
+                        f"REGRESSION: {name} of {results['size']} instances: {key} went from {old_value} to {new_value}"
+                    )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        type=lambda s: [int(size) for size in s.split(",")],
+        default=DEFAULT_SIZES,
+        help="Comma-separated numbers of instances",
+    )
+    parser.add_argument("--jobs", "-j", type=int, default=1)
+    parser.add_argument("--store", default="copy")
+    parser.add_argument("--layout", default="directories")
+    parser.add_argument(
+        "--no-strace",
+        dest="strace",
+        action="store_false",
+        help="Don't count syscalls, even if strace is installed",
+    )
+    parser.add_argument("--output", type=Path, help="Write the results to this JSON file")
+    parser.add_argument(
+        "--compare", type=Path, help="A previous --output file to compare against"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative slowdown (or growth) to allow before reporting a regression",
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="Don't delete each matrix afterwards"
+    )
+    parser.add_argument("--dir", type=Path, help="Where to create the matrices")
+    args = parser.parse_args()
+
+    if args.strace and shutil.which("strace") is None:
+        args.strace = False
+        print("strace is not installed, so syscalls won't be counted\n")
+
+    bench_dir = Path(args.dir or tempfile.mkdtemp(prefix="smatrix-bench-")).resolve()
+    os.makedirs(bench_dir, exist_ok=True)
+
+    bin_dir = write_stubs(bench_dir)
+    data_dir = write_data(bench_dir)
+    env = {
+        **os.environ,
+        "PATH": f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}",
+        "PYTHONPATH": f"{REPO_DIR}{os.pathsep}{os.environ.get('PYTHONPATH', '')}",
+        "BENCH_DIR": str(bench_dir),
+        # don't touch the real registry, and don't skip validation
+        "SMATRIX_REGISTRY": str(bench_dir / "registry.jsonl"),
+        "SMATRIX_CONFIG_CACHE": str(bench_dir / "config_cache"),
+    }
+
+    all_results = []
+    try:
+        for size in args.sizes:
+            shutil.rmtree(bench_dir / "config_cache", ignore_errors=True)
+            all_results.append(bench_size(bench_dir, data_dir, size, args, env))
+    finally:
+        if not args.keep and args.dir is None:
+            shutil.rmtree(bench_dir, ignore_errors=True)
+
+    print_results(all_results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(all_results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(all_results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
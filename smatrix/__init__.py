@@ -1,2 +1,27 @@
-from . import instances
-from . import config
+import importlib
+
+# submodules are imported on first use, so that starting the command line
+# doesn't pay for the dependencies of every command
+SUBMODULES = (
+    "collect",
+    "config",
+    "create",
+    "default",
+    "generate",
+    "groups",
+    "instances",
+    "logs",
+    "packed",
+    "profiling",
+    "registry",
+    "slurm",
+    "stats",
+    "store",
+    "util",
+)
+
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
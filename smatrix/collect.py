@@ -0,0 +1,172 @@
+import csv
+import glob
+import json
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from . import config
+from . import instances
+from . import packed
+from . import slurm
+from . import util
+
+log = logging.getLogger("smatrix")
+
+# columns of the results which clash with a variable of the environment are
+# given this prefix
+RESULT_PREFIX = "result_"
+
+
+def parse_json(path):
+    with open(path, "r") as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        return {path.stem: json.dumps(data)}
+    return flatten(data)
+
+
+def flatten(data, prefix=""):
+    flat = dict()
+    for k, v in data.items():
+        if isinstance(v, dict):
+            flat.update(flatten(v, f"{prefix}{k}_"))
+        elif isinstance(v, list):
+            flat[f"{prefix}{k}"] = json.dumps(v)
+        else:
+            flat[f"{prefix}{k}"] = v
+    return flat
+
+
+def parse_csv(path):
+    last = dict()
+    with open(path, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            last = row
+    return last
+
+
+def parse_kv(path):
+    values = dict()
+    with open(path, "r") as f:
+        for line in f:
+            for separator in ("=", ":"):
+                key, found, value = line.partition(separator)
+                if found and key.strip():
+                    values[key.strip()] = value.strip()
+                    break
+    return values
+
+
+def parse_text(path):
+    with open(path, "r") as f:
+        return {path.stem: f.read().strip()}
+
+
+# How `smatrix collect` turns each file it reads into columns:
+#   json - a JSON object, whose nested objects are flattened into
+#          `outer_inner` columns
+#   csv  - a CSV file with a header, whose last row is used
+#   kv   - lines of `key=value` or `key: value`
+#   text - the whole file, as a column named after the file
+PARSER_FUNCTIONS = {
+    "json": parse_json,
+    "csv": parse_csv,
+    "kv": parse_kv,
+    "text": parse_text,
+}
+
+
+def iter_environments(matrix_path, cfg):
+    """Yield (id, flattened environment) for every instance of the matrix"""
+    if cfg["matrix"] is not None:
+        from .create import iter_matrix
+
+        for id, state in iter_matrix(cfg):
+            yield id, config.get_environment(cfg, state, id)
+        return
+
+    # a streamed matrix isn't kept in the snapshot, so each environment has to
+    # be read back from what was written when the matrix was created
+    for id in range(cfg["count"]):
+        if cfg["general"].get("layout") == "packed":
+            yield id, packed.read_environment(matrix_path, id)
+            continue
+        yield id, instances.read_environment_file(
+            Path(matrix_path) / "jobs" / str(id) / "job_environment"
+        )
+
+
+def read_results(matrix_path, id, env, pattern, parser):
+    """The row of one instance: its environment, joined with its results"""
+    instance_dir = Path(matrix_path) / "jobs" / str(id)
+    # the pattern can use the instance's variables, e.g. "out_$seed.json"
+    pattern = config.compile_template(pattern).safe_substitute(env)
+
+    row = dict(env)
+    paths = sorted(glob.glob(str(instance_dir / pattern)))
+    for path in paths:
+        try:
+            results = PARSER_FUNCTIONS[parser](Path(path))
+        except (OSError, ValueError, csv.Error) as err:
+            log.warning(f"Could not read '{path}': {err}")
+            continue
+
+        for k, v in results.items():
+            row[RESULT_PREFIX + k if k in env else k] = v
+
+    return row, bool(paths)
+
+
+def collect(args):
+    # results can be collected from a matrix which was never submitted, too
+    matrix_path = slurm.find_matrix(args, submitted=False)
+    if matrix_path is None:
+        return 1
+
+    with open(matrix_path / "matrix_config_snapshot.json", "r") as f:
+        cfg = json.load(f)
+
+    # the command line overrides the [collect] section of the config
+    settings = cfg.get("collect") or dict()
+    pattern = args.files or settings.get("files")
+    parser = args.format or settings.get("format", "json")
+    if not pattern:
+        log.error(
+            "Nothing to collect. Pass --files, or add a [collect] section with `files` to the config"
+        )
+        return 1
+
+    log.info(
+        f"Collecting '{pattern}' ({parser}) from {cfg['count']} instances of {matrix_path}"
+    )
+
+    out = open(args.output, "w", newline="") if args.output else sys.stdout
+    missing = 0
+    try:
+        with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+            rows = util.map_bounded(
+                pool,
+                lambda id, env: read_results(matrix_path, id, env, pattern, parser),
+                iter_environments(matrix_path, cfg),
+                window=args.jobs * 4,
+            )
+
+            def counted(rows):
+                nonlocal missing
+                for row, found in rows:
+                    missing += not found
+                    yield row
+
+            util.write_rows(out, counted(rows), jsonl=util.is_jsonl(args.output))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    if missing:
+        log.warning(f"{missing} instances had no files matching '{pattern}'")
+    if args.output:
+        log.info(f"Wrote {cfg['count']} rows to '{args.output}'")
+    return 0
+
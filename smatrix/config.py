@@ -1,23 +1,16 @@
-from schema import (
-    Schema,
-    And,
-    Use,
-    Optional,
-    Or,
-    Regex,
-    Forbidden,
-    SchemaError,
-)
-import toml
 import os
-from rich.pretty import pretty_repr
+import hashlib
+import json
 from datetime import datetime
 from dataclasses import dataclass
 from pathlib import Path
 from string import Template
+from functools import lru_cache
 
 import logging
 
+from .store import STORE_MODES
+
 log = logging.getLogger("smatrix")
 
 DEFAULT_ARRAY_EXEC_BODY = """
@@ -34,87 +27,348 @@ done < job_environment
 """
 
 
-def validate(input_file):
-    SH_VAR_NAME = Regex(
-        r"^[a-zA-Z_][a-zA-Z_0-9]+$",
-        error="Not a valid Bash variable name: {}",
-    )
+# validated configs are cached here, keyed by a hash of the config file (and of
+# this module, whose schema and defaults decide what a validated config is)
+CONFIG_CACHE_ENV = "SMATRIX_CONFIG_CACHE"
+# every edit of a config is a new entry, so only the most recently used are kept
+MAX_CACHED_CONFIGS = 64
+
+SH_VAR_NAME_PATTERN = r"^[a-zA-Z_][a-zA-Z_0-9]+$"
+
+# stage names end up in file names and job states
+STAGE_NAME_PATTERN = r"^[a-zA-Z0-9_-]+$"
 
-    schema = Schema(
-        And(
-            Use(toml.load),
-            {
-                "general": {
-                    "name": str,
-                    "params": str,
-                    "concurrent": int,
-                    # the instance and root labels are both optional
-                    Optional(
-                        "instance_label", default="${MATRIX_JOB_ID}_${MATRIX_JOB_LABEL}"
-                    ): str,
-                    Optional("root_label", default="%Y%m%d_%H%M%S_$MATRIX_NAME"): str,
-                },
-                # each string key value should be accompanied by a corresponding string or dictionary of parameters
-                "matrix": {
-                    SH_VAR_NAME: [
-                        Or(
-                            str,  # it can either be a string value...
-                            int,  # or an int...
-                            # or a dictionary of string/int values
-                            {SH_VAR_NAME: Or(str, int)},
-                        )
-                    ],
-                },
-                # We do pathing later, after all substitutions have been made
-                Optional("symlinks"): {Optional(str): str},
-                # Copying
-                Optional("copies"): {
-                    Optional(str): {
-                        "path": str,
-                        Optional("template", default=False): bool,
-                    }
-                },
-                # the actual script to run
-                "script": {
+
+@lru_cache(maxsize=None)
+def get_schema():
+    """Build the config schema, once"""
+    # these are slow to import, and only needed when loading a config file
+    from schema import Schema, And, Optional, Or
+
+    return Schema(
+        {
+            "general": {
+                "name": str,
+                "params": str,
+                "concurrent": int,
+                # the instance and root labels are both optional
+                Optional(
+                    "instance_label", default="${MATRIX_JOB_ID}_${MATRIX_JOB_LABEL}"
+                ): str,
+                Optional("root_label", default="%Y%m%d_%H%M%S_$MATRIX_NAME"): str,
+                # how files shared by every instance are stored; see store.py
+                Optional("store", default="copy"): Or(*STORE_MODES),
+                # "packed" writes every environment into one file, and only
+                # creates job directories when each task runs
+                Optional("layout", default="directories"): Or(
+                    "directories", "packed"
+                ),
+                # larger matrices are split into several arrays. When 0,
+                # this is the cluster's MaxArraySize, if it can be found
+                Optional("max_array_size", default=0): int,
+                # run this many instances in each array task, one after
+                # another or all at once, up to the task's CPUs
+                Optional("pack", default=1): And(int, lambda n: n >= 1),
+                Optional("pack_mode", default="sequential"): Or(
+                    "sequential", "parallel"
+                ),
+            },
+            # matrices can have many thousands of values, which is too slow to
+            # check with schema, so they're checked by validate_matrix instead
+            "matrix": dict,
+            # which combinations of the matrix to create, other than all of
+            # them; see validate_combinations
+            Optional(
+                "combinations",
+                default=lambda: {"zip": [], "exclude": [], "include": []},
+            ): {
+                Optional("zip", default=lambda: []): [[str]],
+                Optional("exclude", default=lambda: []): [dict],
+                Optional("include", default=lambda: []): [dict],
+            },
+            # We do pathing later, after all substitutions have been made
+            Optional("symlinks", default=lambda: {}): {Optional(str): str},
+            # Copying
+            Optional("copies", default=lambda: {}): {
+                Optional(str): {
+                    "path": str,
+                    Optional("template", default=False): bool,
+                }
+            },
+            # what `smatrix collect` reads from each instance; see collect.py
+            Optional("collect"): {
+                "files": str,
+                Optional("format", default="json"): Or(
+                    "json", "csv", "kv", "text"
+                ),
+            },
+            # the actual script to run. With [stages], `slurm_exec` is given by
+            # each stage instead, and these files are shared by every stage
+            Optional(
+                "script", default=lambda: {"load_env.sh": LOAD_ENVIRONMENT}
+            ): {
+                Optional("slurm_exec"): str,
+                Optional("load_env.sh", default=LOAD_ENVIRONMENT): str,
+                Optional(str): str,
+            },
+            # scripts which run one after another for each instance; see
+            # validate_stages
+            Optional("stages"): {
+                str: {
                     "slurm_exec": str,
-                    Optional("load_env.sh", default=LOAD_ENVIRONMENT): str,
                     Optional(str): str,
-                },
+                }
             },
-        )
+        }
     )
 
-    try:
-        config = schema.validate(input_file)
 
-        config = interpret_config(config)
+def validate_matrix(matrix):
+    """Check that each string key is accompanied by a list of values
 
-        log.info("Loaded config:\n%s", pretty_repr(config))
-        return config
-    except SchemaError as err:
-        # handle bash variable name issue manually
-        import re
+    Each value can either be a string, an int, or a dictionary of string/int
+    values. This is equivalent to the schema
+
+        {SH_VAR_NAME: [Or(str, int, {SH_VAR_NAME: Or(str, int)})]}
+
+    but doesn't go through schema's (much slower) generic validation.
+    """
+    from schema import SchemaError
+    import re
+
+    var_name = re.compile(SH_VAR_NAME_PATTERN)
+
+    for key, values in matrix.items():
+        if not var_name.match(key):
+            raise SchemaError(
+                f"Matrix variable '{key}' must be a valid Bash variable name"
+            )
+        if not isinstance(values, list):
+            raise SchemaError(f"Matrix variable '{key}' must be a list of values")
+
+        for value in values:
+            if isinstance(value, (str, int)):
+                continue
+
+            if not isinstance(value, dict):
+                raise SchemaError(
+                    f"Matrix variable '{key}' has value {value!r}, which is not a string, integer or table"
+                )
+            for k2, v2 in value.items():
+                if not var_name.match(k2):
+                    raise SchemaError(
+                        f"Matrix variable '{key}' has key '{k2}', which must be a valid Bash variable name"
+                    )
+                if not isinstance(v2, (str, int)):
+                    raise SchemaError(
+                        f"Matrix variable '{key}' has value {v2!r} for '{k2}', which is not a string or integer"
+                    )
 
-        match = re.match(
-            r"Key 'matrix' error:\nWrong key '(.+)' in {'", str(err), re.MULTILINE
+
+def validate_combinations(matrix, combinations):
+    """Check the [combinations] section against the matrix
+
+    - `zip` is a list of groups of matrix variables, which all have the same
+      number of values. The variables of a group take their values together,
+      rather than in every combination
+    - `exclude` is a list of tables of matrix variables and values. Any
+      combination which matches every value of one of these isn't created. A
+      variable whose values are tables is matched on its label (or first value),
+      or on each of the values given in a table
+    - `include` is a list of extra instances, each a table of variables and
+      values, which are created after the rest of the matrix
+    """
+    from schema import SchemaError
+
+    zipped = set()
+    for group in combinations["zip"]:
+        for key in group:
+            if key not in matrix:
+                raise SchemaError(f"Zipped variable '{key}' is not in the matrix")
+            if key in zipped:
+                raise SchemaError(f"Matrix variable '{key}' is zipped more than once")
+            zipped.add(key)
+
+        lengths = {len(matrix[key]) for key in group}
+        if len(lengths) > 1:
+            raise SchemaError(
+                f"Zipped variables {', '.join(group)} must all have the same number of values"
+            )
+
+    for rule in combinations["exclude"]:
+        if not rule:
+            raise SchemaError("An exclude rule must name at least one variable")
+        for key in rule:
+            if key not in matrix:
+                raise SchemaError(f"Excluded variable '{key}' is not in the matrix")
+
+    # extra instances can have any variables, with the same values as the matrix
+    for instance in combinations["include"]:
+        validate_matrix({key: [value] for key, value in instance.items()})
+
+
+def validate_stages(config):
+    """Check that there's exactly one way to run each instance
+
+    Each table of [stages] is a stage, with its own `slurm_exec` and any other
+    files, in the same form as [script]. Stages run in the order they are
+    written, and each instance's run of a stage waits for its run of the
+    previous stage to succeed.
+    """
+    from schema import SchemaError
+    import re
+
+    stages = config.get("stages")
+    if not stages:
+        if "slurm_exec" not in config["script"]:
+            raise SchemaError("Key 'script' error:\nMissing key: 'slurm_exec'")
+        return
+
+    if "slurm_exec" in config["script"]:
+        raise SchemaError(
+            "Key 'script' error:\nWith stages, each stage has its own 'slurm_exec', so 'script' can't have one"
         )
-        if match:
-            keyname = match.group(1)
+
+    files = dict(config["script"])
+    for name, scripts in stages.items():
+        if not re.match(STAGE_NAME_PATTERN, name):
             raise SchemaError(
-                f"Matrix variable '{keyname}' must be a valid Bash variable name"
+                f"Stage name '{name}' must only contain letters, numbers, '_' and '-'"
             )
+        # every stage's files end up in the same instance directory
+        for k, v in scripts.items():
+            if k != "slurm_exec" and files.setdefault(k, v) != v:
+                raise SchemaError(
+                    f"Stage '{name}' has a different '{k}' to another stage"
+                )
+
+
+def validate(input_file):
+    from schema import SchemaError
+    import toml
+    from rich.pretty import pretty_repr
+
+    contents = input_file.read()
 
-        # otherwise, propagate
-        raise err
+    config = read_cached_config(contents)
+    if config is None:
+        config = get_schema().validate(toml.loads(contents))
+        validate_matrix(config["matrix"])
+        validate_combinations(config["matrix"], config["combinations"])
+        validate_stages(config)
+
+        if config["general"]["layout"] == "packed" and (
+            config.get("symlinks") or config.get("copies")
+        ):
+            raise SchemaError(
+                "The packed layout does not support symlinks or copies, as there are no job directories to put them in until each job runs"
+            )
+
+        write_cached_config(contents, config)
+    else:
+        log.debug("Using cached validated config")
+
+    config = interpret_config(config)
+
+    # don't print every value of a large matrix
+    log.info("Loaded config:\n%s", pretty_repr(config, max_length=20))
+    return config
+
+
+def get_config_cache_dir():
+    if os.environ.get(CONFIG_CACHE_ENV):
+        return Path(os.environ[CONFIG_CACHE_ENV])
+
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "smatrix" / "configs"
+
+
+def get_config_digest(contents):
+    h = hashlib.sha256()
+    with open(__file__, "rb") as f:
+        h.update(f.read())
+    h.update(contents.encode())
+    return h.hexdigest()
+
+
+def read_cached_config(contents):
+    path = get_config_cache_dir() / f"{get_config_digest(contents)}.json"
+    try:
+        with open(path, "r") as f:
+            config = json.load(f)
+        # mark it as recently used, so that it isn't pruned
+        os.utime(path)
+        return config
+    except (OSError, ValueError):
+        return None
+
+
+def write_cached_config(contents, config):
+    path = get_config_cache_dir() / f"{get_config_digest(contents)}.json"
+    try:
+        # TOML has values which JSON doesn't (e.g. dates), and configs with
+        # them just aren't cached
+        data = json.dumps(config)
+    except (TypeError, ValueError) as err:
+        log.debug(f"Not caching validated config: {err}")
+        return
+
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        os.makedirs(path.parent, exist_ok=True)
+        with open(tmp, "w") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        prune_cached_configs(path.parent)
+    except OSError as err:
+        # the cache is only ever a shortcut, so never fail because of it
+        log.debug(f"Could not cache validated config at '{path}': {err}")
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def prune_cached_configs(cache_dir):
+    """Remove all but the MAX_CACHED_CONFIGS most recently used configs"""
+    entries = []
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.name.endswith(".json"):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except OSError:
+                    pass
+
+    entries.sort(reverse=True)
+    for mtime, path in entries[MAX_CACHED_CONFIGS:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
 
 def interpret_config(config):
     config["root_dir"] = get_root_directory(config)
     config["job_dir"] = config["root_dir"] / "jobs"
 
+    if config.get("stages"):
+        # each stage's files are written alongside the others, and its
+        # `slurm_exec` becomes the script that its executors run
+        for stage, scripts in config["stages"].items():
+            for k, v in scripts.items():
+                name = stage_script(stage) if k == "slurm_exec" else k
+                config["script"][name] = v
+        config["stages"] = list(config["stages"])
+
     return config
 
 
+def stage_script(stage):
+    """The script which runs one stage of an instance"""
+    return f"job_run_{stage}.sh"
+
+
 def get_root_directory(config):
     envs = get_environment(config)
     label = template_envs(config["general"]["root_label"], envs)
@@ -158,5 +412,22 @@ def get_environment(config, state=dict(), id=None):
     return new_cfg
 
 
+@lru_cache(maxsize=256)
+def compile_template(s):
+    # the same handful of patterns (labels, symlink paths) are templated for
+    # every instance, so only compile each one once
+    return Template(s)
+
+
 def template_envs(s, envs):
-    return Template(s).substitute(**envs)
+    return compile_template(s).substitute(envs)
+
+
+def template_identifiers(s):
+    """The set of variable names referenced by a template string"""
+    identifiers = set()
+    for match in Template.pattern.finditer(s):
+        name = match.group("named") or match.group("braced")
+        if name:
+            identifiers.add(name)
+    return identifiers
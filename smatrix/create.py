@@ -1,21 +1,38 @@
 from . import config
+from . import groups
 from . import instances
 from . import slurm
+from . import packed
+from . import registry
+from . import profiling
 
 import sys
+import json
 import logging
 import itertools
+import math
 import os
+import shutil
+from pathlib import Path
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 log = logging.getLogger("smatrix")
 
 
-def create(args):
-    log.info(f"Creating matrix from '{args.config}'")
+# one line per instance, of its id, digest, directory and the files smatrix wrote
+# there (as a JSON list), so that `update` knows which instances have changed and
+# what it can safely replace. Lines are written as instances finish, so they
+# aren't necessarily in id order. The scripts are the same for every instance, so
+# they get a single line of their own, of "scripts", their digest and names
+MANIFEST_FILE = "manifest.tsv"
+MANIFEST_SCRIPTS = "scripts"
 
+
+def load_config(path):
     try:
-        with open(args.config, "r") as config_file:
-            cfg = config.validate(config_file)
+        with open(path, "r") as config_file:
+            return config.validate(config_file)
     except Exception as err:
         log.error(
             "[bold red]Failed to load config file:[/bold red]\n%s",
@@ -24,48 +41,87 @@ def create(args):
         )
         sys.exit(1)
 
+
+def create(args):
+    log.info(f"Creating matrix from '{args.config}'")
+
+    if args.profile or args.cprofile:
+        profiling.start(cprofile=args.cprofile)
+
+    with profiling.phase("validate"):
+        cfg = load_config(args.config)
+
     log.debug(f"Using root directory '{cfg['root_dir']}'")
 
     create_from_cfg(args, cfg)
+    profiling.finish(cfg, jobs=args.jobs)
 
 
-def create_from_cfg(args, cfg):
+def create_from_cfg(args, cfg, on_created=None):
+    # anything resolved from the filesystem is shared between the instances of
+    # this matrix only
+    instances.reset_caches()
+    with profiling.phase("glob"):
+        instances.preload_globs(cfg)
+
     # will make jobs and root dir (as job dir is a subdirectory)
+    root_existed = os.path.exists(cfg["root_dir"])
     os.makedirs(cfg["job_dir"], exist_ok=False)
 
-    # create iteration matrix
-    # NB: as this requires Python ^3.6, dict key order is preserved
-    if isinstance(cfg["matrix"], dict):
-        keys = cfg["matrix"].keys()
-        values = cfg["matrix"].values()
-        matrix = [
-            (id, dict(zip(keys, inst)))
-            for id, inst in enumerate(itertools.product(*values))
-        ]
-        cfg["count"] = len(matrix)
-    elif isinstance(cfg["matrix"], list):
-        # iterate through each one
-        matrix = list(enumerate(cfg["matrix"]))
-        cfg["count"] = len(matrix)
-    else:
-        log.error("Matrix is not a dictionary or a list!")
-        raise Exception
+    # the size is known up front for dictionaries and lists; anything else (e.g.
+    # a stream of CSV rows) is counted as it is consumed
+    cfg["count"] = matrix_size(cfg)
+    # if the #SBATCH parameters use matrix variables, each instance's group is
+    # worked out as it goes by
+    matrix = groups.track(cfg, iter_matrix(cfg))
 
-    for id, state in matrix:
-        inst = instances.Instance(state, cfg, id)
-        inst.update_filesystem()
-        inst.write_files()
+    try:
+        if cfg["general"]["layout"] == "packed":
+            with profiling.phase("pack"):
+                cfg["count"] = packed.write(cfg, matrix)
+        else:
+            with open(cfg["root_dir"] / MANIFEST_FILE, "w") as manifest:
+                write_manifest_scripts(manifest, scripts_entry(cfg))
+                cfg["count"] = materialise_all(
+                    cfg,
+                    materialise,
+                    jobs=getattr(args, "jobs", 1) or 1,
+                    done=lambda id, entry: write_manifest_entry(manifest, id, entry),
+                    matrix=matrix,
+                )
 
-        # create symlink
-        os.symlink(inst.dir, cfg["job_dir"] / str(inst.id))
+        if not cfg["count"]:
+            raise ValueError("The matrix does not have any instances")
+    except BaseException:
+        # don't leave a half-built matrix behind, but only remove the root if
+        # there's nothing in it that we didn't make
+        if root_existed:
+            log.error(
+                "[bold red]Failed to create matrix in existing directory '%s', which may need to be cleaned up manually[/]",
+                cfg["root_dir"],
+                extra={"markup": True},
+            )
+        else:
+            log.error(
+                "[bold red]Failed to create matrix, removing '%s'[/]",
+                cfg["root_dir"],
+                extra={"markup": True},
+            )
+            shutil.rmtree(cfg["root_dir"], ignore_errors=True)
+        raise
+
+    with profiling.phase("supplementary"):
+        slurm.create_supplementary_files(cfg)
+    registry.record("create", cfg)
+    if on_created:
+        on_created()
 
-    slurm.create_supplementary_files(cfg)
     if args.start:
-        job_id = slurm.execute_batch(cfg)
-        with open(cfg["root_dir"] / "job_id", "w") as f:
-            f.write(str(job_id))
+        with profiling.phase("sbatch"):
+            job_ids = slurm.execute_batch(cfg)
+        slurm.write_job_ids(cfg["root_dir"], job_ids)
         log.debug(
-            f"[bold yellow]Started matrix with job ID {job_id}[/]",
+            f"[bold yellow]Started matrix with job ID {', '.join(job_ids)}[/]",
             extra={"markup": True},
         )
     else:
@@ -73,7 +129,380 @@ def create_from_cfg(args, cfg):
             f"[bold red]Did not start the matrix, as the --start flag was not passed. You can manually start it using:[/]",
             extra={"markup": True},
         )
-        log.warn(
-            f"$ sbatch {cfg['root_dir']}/executor.sh",
-            extra={"markup": True},
+        log.warn(f"$ smatrix start {cfg['root_dir']}")
+        if cfg.get("stages"):
+            # sbatch on its own would run every stage at once
+            log.warn(
+                "Don't submit a staged matrix's executors with sbatch, as they'd skip the dependencies between its stages"
+            )
+        elif len(cfg["arrays"]) == 1:
+            # a single array records its own job ID, so it can also be
+            # submitted as is
+            log.warn(f"$ sbatch {cfg['root_dir']}/{cfg['arrays'][0]['script']}")
+
+
+def update(args):
+    matrix_path = Path(args.matrix_path).resolve()
+    log.info(f"Updating matrix at '{matrix_path}' from '{args.config}'")
+
+    cfg = load_config(args.config)
+
+    # the root is wherever the matrix was originally created, not wherever the
+    # root label would put a new one
+    cfg["root_dir"] = matrix_path
+    cfg["job_dir"] = matrix_path / "jobs"
+
+    update_from_cfg(args, cfg)
+
+
+def update_from_cfg(args, cfg):
+    if not (cfg["root_dir"] / "matrix_config_snapshot.json").exists():
+        log.error(f"'{cfg['root_dir']}' does not contain a matrix")
+        return 1
+
+    instances.reset_caches()
+    instances.preload_globs(cfg)
+    os.makedirs(cfg["job_dir"], exist_ok=True)
+
+    if cfg["general"]["layout"] == "packed":
+        # there's nothing per-instance to preserve, and rewriting everything is
+        # only a couple of files
+        cfg["count"] = packed.write(cfg, groups.track(cfg, iter_matrix(cfg)))
+        slurm.create_supplementary_files(cfg)
+        log.info(f"Rewrote {cfg['count']} packed instances")
+        return 0
+
+    old_entries, old_scripts = read_manifest(cfg)
+    jobs = getattr(args, "jobs", 1) or 1
+
+    # work out what every instance looks like now, before touching anything
+    new_entries = dict()
+    cfg["count"] = materialise_all(
+        cfg,
+        lambda cfg, id, state: manifest_entry(instances.Instance(state, cfg, id)),
+        jobs=jobs,
+        done=new_entries.__setitem__,
+        matrix=groups.track(cfg, iter_matrix(cfg)),
+    )
+
+    changed = {
+        id
+        for id, entry in new_entries.items()
+        if id not in old_entries or old_entries[id][0] != entry[0]
+    }
+    removed = old_entries.keys() - new_entries.keys()
+
+    scripts = scripts_entry(cfg)
+    scripts_changed = old_scripts is None or old_scripts[0] != scripts[0]
+    old_script_names = old_scripts[1] if old_scripts else []
+    stale_scripts = set(old_script_names) - set(scripts[1])
+
+    # remove whatever the changed and removed instances used to have, all at
+    # once, so that an instance moving into another's old directory (e.g. when
+    # two labels are swapped) can't race with that one moving out
+    for id in sorted(changed | removed):
+        instances.remove_file(cfg["job_dir"] / str(id))
+        if id in old_entries:
+            remove_written_files(cfg, old_entries[id], old_script_names)
+
+    # a directory which no instance uses any more is only removed if nothing
+    # is left in it, i.e. it doesn't hold any outputs
+    new_dirs = {entry[1] for entry in new_entries.values()}
+    old_dirs = {old_entries[id][1] for id in removed | changed if id in old_entries}
+    kept = []
+    for rel_dir in old_dirs - new_dirs:
+        if not remove_empty_dirs(cfg["root_dir"], rel_dir):
+            kept.append(rel_dir)
+    if kept:
+        log.warning(
+            f"Kept {len(kept)} directories which no instance uses any more, as they still hold files smatrix didn't write (e.g. '{kept[0]}')"
+        )
+
+    def rewrite(cfg, id, state):
+        if id in changed:
+            log.debug(f"Instance {id} has changed, rewriting it")
+            write_instance(cfg, instances.Instance(state, cfg, id), replace=True)
+        elif scripts_changed:
+            dir = cfg["root_dir"] / new_entries[id][1]
+            for name in stale_scripts:
+                instances.remove_file(dir / name)
+            instances.write_scripts(cfg, dir, replace=True)
+
+    materialise_all(cfg, rewrite, jobs=jobs, matrix=iter_matrix(cfg))
+
+    with open(cfg["root_dir"] / MANIFEST_FILE, "w") as manifest:
+        write_manifest_scripts(manifest, scripts)
+        for id, entry in new_entries.items():
+            write_manifest_entry(manifest, id, entry)
+
+    slurm.create_supplementary_files(cfg)
+
+    log.info(
+        f"Rewrote {len(changed)} of {cfg['count']} instances"
+        + (
+            f" (and the scripts of the other {cfg['count'] - len(changed)})"
+            if scripts_changed and len(changed) < cfg["count"]
+            else ""
+        )
+        + f", and removed {len(removed)} instances"
+    )
+    return 0
+
+
+def materialise(cfg, id, state):
+    with profiling.phase("expand", id):
+        inst = instances.Instance(state, cfg, id)
+    write_instance(cfg, inst)
+    return manifest_entry(inst)
+
+
+def write_instance(cfg, inst, replace=False):
+    inst.update_filesystem(replace=replace)
+    with profiling.phase("scripts", inst.id):
+        inst.write_files(replace=replace)
+
+    # create symlink
+    with profiling.phase("symlink", inst.id):
+        profiling.count("symlink")
+        link = cfg["job_dir"] / str(inst.id)
+        if replace:
+            instances.remove_file(link)
+        os.symlink(inst.dir, link)
+
+
+def remove_written_files(cfg, entry, script_names):
+    """Remove the files smatrix wrote for an instance, leaving any outputs"""
+    digest, rel_dir, files = entry
+    dir = cfg["root_dir"] / rel_dir
+    for name in itertools.chain(files, script_names):
+        instances.remove_file(dir / name)
+
+
+def remove_empty_dirs(root_dir, rel_dir):
+    """Remove a directory if (apart from empty subdirectories) it's empty, along
+    with any parents which are then empty. Returns whether it was removed"""
+    dir = root_dir / rel_dir
+    for parent, subdirs, files in os.walk(dir, topdown=False):
+        for subdir in subdirs:
+            try:
+                os.rmdir(os.path.join(parent, subdir))
+            except OSError:
+                pass
+    try:
+        os.rmdir(dir)
+    except FileNotFoundError:
+        return True
+    except OSError:
+        return False
+
+    for parent in Path(rel_dir).parents:
+        if parent == Path("."):
+            break
+        try:
+            os.rmdir(root_dir / parent)
+        except OSError:
+            break
+    return True
+
+
+def manifest_entry(inst):
+    with profiling.phase("digest", inst.id):
+        return [
+            inst.digest(),
+            str(inst.dir.relative_to(inst.cfg["root_dir"])),
+            inst.written_files(),
+        ]
+
+
+def scripts_entry(cfg):
+    return [
+        instances.scripts_digest(cfg),
+        [name for name, _ in instances.script_files(cfg)],
+    ]
+
+
+def read_manifest(cfg):
+    """The manifest's instances, as {id: [digest, rel_dir, files]}, and its
+    scripts, as [digest, names] (or None if they aren't there)"""
+    manifest = dict()
+    scripts = None
+    try:
+        with open(cfg["root_dir"] / MANIFEST_FILE, "r") as f:
+            for line in f:
+                key, digest, rest = line.rstrip("\n").split("\t", 2)
+                if key == MANIFEST_SCRIPTS:
+                    scripts = [digest, json.loads(rest)]
+                    continue
+
+                rel_dir, files = rest.rsplit("\t", 1)
+                manifest[int(key)] = [digest, rel_dir, json.loads(files)]
+    except FileNotFoundError:
+        log.warning(
+            "No manifest found, so every instance will be rewritten. This is expected for matrices created by older versions of smatrix."
         )
+    return manifest, scripts
+
+
+def write_manifest_entry(f, id, entry):
+    digest, rel_dir, files = entry
+    f.write(f"{id}\t{digest}\t{rel_dir}\t{json.dumps(files)}\n")
+
+
+def write_manifest_scripts(f, entry):
+    digest, names = entry
+    f.write(f"{MANIFEST_SCRIPTS}\t{digest}\t{json.dumps(names)}\n")
+
+
+def materialise_all(cfg, work, jobs=1, done=None, matrix=None):
+    """Call `work(cfg, id, state)` for every instance of the matrix
+
+    Each result is passed to `done(id, result)` on the calling thread, and the
+    number of instances is returned. With more than one job, instances are
+    handled by a pool of threads; laying out instances is almost entirely
+    metadata I/O, which is where shared filesystems are slow.
+
+    `matrix` defaults to `iter_matrix(cfg)`.
+    """
+    done = done or (lambda id, result: None)
+    if matrix is None:
+        matrix = iter_matrix(cfg)
+
+    count = 0
+    if jobs <= 1:
+        for id, state in matrix:
+            done(id, work(cfg, id, state))
+            count += 1
+        return count
+
+    # keep only a bounded number of instances in flight, so that memory stays
+    # flat regardless of the size of the matrix
+    max_pending = jobs * 4
+    pending = dict()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        try:
+            for id, state in matrix:
+                pending[pool.submit(work, cfg, id, state)] = id
+                count += 1
+
+                if len(pending) >= max_pending:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        done(pending.pop(future), future.result())
+
+            for future in list(pending):
+                done(pending.pop(future), future.result())
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+
+    return count
+
+
+def matrix_size(cfg):
+    """Number of instances in the matrix, or None if it can only be known by iterating"""
+    if isinstance(cfg["matrix"], dict):
+        combinations = cfg.get("combinations") or {}
+        if combinations.get("exclude"):
+            return None
+        axes = get_axes(cfg["matrix"], combinations.get("zip", []))
+        return math.prod(len(values) for _, values in axes) + len(
+            combinations.get("include", [])
+        )
+    elif isinstance(cfg["matrix"], list):
+        return len(cfg["matrix"])
+    return None
+
+
+def iter_matrix(cfg):
+    """Lazily yield (id, state) pairs for every instance of the matrix"""
+    # NB: as this requires Python ^3.6, dict key order is preserved
+    if isinstance(cfg["matrix"], dict):
+        combinations = cfg.get("combinations") or {}
+        if any(combinations.values()):
+            return enumerate(iter_combinations(cfg["matrix"], combinations))
+
+        keys = list(cfg["matrix"].keys())
+        values = cfg["matrix"].values()
+        return enumerate(dict(zip(keys, inst)) for inst in itertools.product(*values))
+    elif isinstance(cfg["matrix"], Iterable) and not isinstance(cfg["matrix"], str):
+        # lists, or any stream of states
+        return enumerate(cfg["matrix"])
+    else:
+        log.error("Matrix is not a dictionary or a list!")
+        raise Exception
+
+
+def get_axes(matrix, zip_groups):
+    """The axes of the product, as (keys, values) pairs
+
+    A zipped group is one axis, whose values are tuples with a value for each
+    of its keys. Every other variable is an axis of its own. Axes are in the
+    order that their first variable appears in the matrix.
+    """
+    zipped = {key: group for group in zip_groups for key in group}
+
+    axes = []
+    seen = set()
+    for key in matrix:
+        if key in seen:
+            continue
+        group = zipped.get(key, [key])
+        seen.update(group)
+        axes.append((group, list(zip(*(matrix[k] for k in group)))))
+    return axes
+
+
+def iter_combinations(matrix, combinations):
+    """Yield the states of a matrix with zipped axes, exclusions and inclusions
+
+    The product is built one axis at a time, and each exclude rule is checked as
+    soon as all of its variables have a value, so an excluded branch is skipped
+    without visiting any of the combinations below it. Ids follow the same order
+    as the full product, with excluded states left out, then the included states.
+    """
+    keys = list(matrix.keys())
+    axes = get_axes(matrix, combinations["zip"])
+
+    # each rule is checked at the first depth where it can be decided
+    depth_of = {key: depth for depth, (group, _) in enumerate(axes) for key in group}
+    rules_at = [[] for _ in axes]
+    for rule in combinations["exclude"]:
+        rules_at[max(depth_of[key] for key in rule)].append(rule)
+
+    state = dict()
+
+    def expand(depth):
+        if depth == len(axes):
+            yield {key: state[key] for key in keys}
+            return
+
+        group, values = axes[depth]
+        rules = rules_at[depth]
+        for value in values:
+            state.update(zip(group, value))
+            if rules and any(matches_rule(state, rule) for rule in rules):
+                continue
+            yield from expand(depth + 1)
+
+    yield from expand(0)
+
+    for instance in combinations["include"]:
+        yield dict(instance)
+
+
+def matches_rule(state, rule):
+    for key, wanted in rule.items():
+        value = state[key]
+        if isinstance(wanted, dict):
+            if not isinstance(value, dict):
+                return False
+            if any(str(value.get(k)) != str(v) for k, v in wanted.items()):
+                return False
+        else:
+            if isinstance(value, dict):
+                # the same label as the instance label uses
+                value = value.get("label", next(iter(value.values())))
+            if str(value) != str(wanted):
+                return False
+    return True
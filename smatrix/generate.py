@@ -2,6 +2,7 @@ import logging
 import os
 import csv
 import time
+from collections import deque
 
 from rich.console import Console
 from rich.table import Table
@@ -18,7 +19,7 @@ def generate(args):
     shell_file = args.shell_file
     parameters = args.parameters
     name = args.name or time.strftime("%Y%m%d-%H%M")
-    log.info(f"Creating a matrix job at directory '{name}' with parameters:")
+    log.info(f"Creating a matrix job at directory '{name}'")
 
     has_shebang = False
     start_commands = []
@@ -39,18 +40,10 @@ def generate(args):
     if parameters.endswith(".txt") or parameters.endswith(".csv"):
         params = read_csv(parameters, headers=args.headers)
 
-    console = Console()
-    table = Table(title="Parameters list")
-
-    keys = params[0].keys()
-    table.add_column("id", justify="right", style="bold cyan")
-    for key in keys:
-        table.add_column(f"${key}", justify="right")
-
-    for idx, param in enumerate(params):
-        table.add_row(str(idx), *map(str, param.values()))
-
-    console.print(table)
+    # rows are streamed straight into the matrix, and only a bounded preview of
+    # them is kept to show once it has been created
+    preview = ParameterPreview(args.preview)
+    params = preview.observe(params)
 
     main_header = "\n".join(start_commands)
     log.info(
@@ -65,15 +58,27 @@ def generate(args):
             "params": main_header,
             "instance_label": "${MATRIX_JOB_ID}",
             "concurrent": 0,
+            "store": "copy",
+            "layout": "directories",
+            "max_array_size": 0,
+            "pack": 1,
+            "pack_mode": "sequential",
         },
         "matrix": params,
+        "parameters_file": os.path.abspath(parameters),
         "symlinks": dict(),
         "copies": dict(),
         "script": {"slurm_exec": open(shell_file, "r").read()},
     }
     cfg = config.interpret_config(cfg)
 
-    create.create_from_cfg(args, cfg)
+    create.create_from_cfg(args, cfg, on_created=lambda: print_preview(preview))
+
+
+def print_preview(preview):
+    console = Console()
+    console.print(preview.table())
+    console.print(preview.stats_table())
 
 
 def read_csv(file, headers=False):
@@ -93,13 +98,109 @@ def read_csv(file, headers=False):
             csvfile.seek(0)
 
         reader = csv.DictReader(csvfile, fieldnames=fieldnames)
-        params = []
 
+        # rows are yielded one at a time, so that the file never has to be held in memory
         for idx, row in enumerate(reader):
             if idx == 0 and not headers and est_header != headers:
                 log.warn(
                     f"Your parameters file may have headers, but you have not provided the '--headers' flag. Parameters are currently being processed as if they do not contain headers.\nIf '{first_row.strip()}' is intended to be a header row, pass in the '--headers' flag. Otherwise, each column can be accessed using '$1' for the first column, '$2' for the second, and so on."
                 )
-            params.append(row)
-
-        return params
+            yield row
+
+
+class ParameterPreview:
+    """Keeps the first and last few rows of a stream of parameters, and column stats"""
+
+    # stop counting distinct values of a column beyond this many
+    MAX_DISTINCT = 1000
+
+    def __init__(self, rows=5):
+        self.rows = rows
+        self.head = []
+        self.tail = deque(maxlen=rows)
+        self.count = 0
+        self.keys = []
+        self.distinct = dict()
+        self.numeric = dict()
+
+    def observe(self, params):
+        """Pass `params` through, taking note of each row as it goes"""
+        for row in params:
+            self.add(row)
+            yield row
+
+    def add(self, row):
+        if not self.count:
+            self.keys = list(row.keys())
+            self.distinct = {key: set() for key in self.keys}
+            self.numeric = {key: None for key in self.keys}
+
+        if len(self.head) < self.rows:
+            self.head.append(row)
+        else:
+            self.tail.append((self.count, row))
+        self.count += 1
+
+        for key in self.keys:
+            value = row.get(key)
+
+            distinct = self.distinct[key]
+            if distinct is not None:
+                distinct.add(value)
+                if len(distinct) > self.MAX_DISTINCT:
+                    self.distinct[key] = None
+
+            # (min, max), while every value is a number, and False after
+            numeric = self.numeric[key]
+            if numeric is False:
+                continue
+            try:
+                number = float(value)
+            except (TypeError, ValueError):
+                self.numeric[key] = False
+                continue
+            if numeric is None:
+                self.numeric[key] = (number, number)
+            else:
+                self.numeric[key] = (min(numeric[0], number), max(numeric[1], number))
+
+    def table(self):
+        table = Table(title=f"Parameters list ({self.count} rows)")
+
+        table.add_column("id", justify="right", style="bold cyan")
+        for key in self.keys:
+            table.add_column(f"${key}", justify="right")
+
+        for idx, param in enumerate(self.head):
+            table.add_row(str(idx), *map(str, param.values()))
+
+        if self.tail and self.tail[0][0] > len(self.head):
+            skipped = self.tail[0][0] - len(self.head)
+            table.add_row("…", *([f"({skipped} rows)"] + [""] * (len(self.keys) - 1)))
+
+        for idx, param in self.tail:
+            table.add_row(str(idx), *map(str, param.values()))
+
+        return table
+
+    def stats_table(self):
+        table = Table(title="Parameter columns")
+
+        table.add_column("column", style="bold cyan")
+        table.add_column("distinct", justify="right")
+        table.add_column("min", justify="right")
+        table.add_column("max", justify="right")
+
+        for key in self.keys:
+            distinct = self.distinct[key]
+            distinct = str(len(distinct)) if distinct is not None else f">{self.MAX_DISTINCT}"
+
+            numeric = self.numeric[key]
+            if numeric:
+                low, high = (f"{x:g}" for x in numeric)
+            else:
+                low = high = ""
+
+            table.add_row(f"${key}", distinct, low, high)
+
+        return table
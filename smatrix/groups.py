@@ -0,0 +1,138 @@
+import itertools
+import logging
+import os
+from functools import lru_cache
+
+from . import config
+from . import util
+
+log = logging.getLogger("smatrix")
+
+# When `general.params` uses matrix variables (e.g. `--cpus-per-task=$threads`),
+# instances are grouped by their resolved #SBATCH parameters, and each group is
+# submitted as its own array(s). The instances of a group usually aren't
+# consecutive, so `groups/<n>.ids` lists them: line i is the id of the instance
+# which position i of the group runs. Lines are fixed width, so that an executor
+# can seek straight to its own with `dd`, as for the packed layout.
+GROUPS_DIR = "groups"
+ID_RECORD = "{:016d}\n"
+ID_RECORD_SIZE = len(ID_RECORD.format(0))
+
+
+def matrix_variables(cfg, first_state):
+    """The names of the matrix's variables, as its instances see them (i.e. with
+    tables flattened to `key_subkey`)
+
+    A streamed matrix (e.g. of CSV rows) can't be looked at in advance, so its
+    first state stands in for the rest.
+    """
+    if isinstance(cfg["matrix"], dict):
+        states = [
+            {key: value} for key, values in cfg["matrix"].items() for value in values
+        ]
+        states += (cfg.get("combinations") or {}).get("include", [])
+    elif isinstance(cfg["matrix"], list):
+        states = cfg["matrix"]
+    else:
+        states = [first_state]
+
+    variables = set()
+    for state in states:
+        for key, value in state.items():
+            if isinstance(value, dict):
+                variables.update(f"{key}_{k2}" for k2 in value)
+            else:
+                variables.add(key)
+    return variables
+
+
+def grouping_variables(cfg, first_state):
+    """The matrix variables which the #SBATCH parameters use
+
+    Anything else (e.g. $HOME, or $MATRIX_JOB_ID) is left for the shell, and
+    doesn't make the parameters depend on the instance.
+    """
+    return config.template_identifiers(cfg["general"]["params"]) & matrix_variables(
+        cfg, first_state
+    )
+
+
+def is_grouped(cfg, first_state):
+    """Whether the #SBATCH parameters depend on the instance"""
+    return bool(grouping_variables(cfg, first_state))
+
+
+def track(cfg, matrix):
+    """Pass (id, state) pairs through, recording the group of each instance
+
+    Only the ranges of ids in each group are kept as the matrix goes by, and
+    the ids files are written once it has been exhausted, at which point
+    `cfg["groups"]` describes every group.
+    """
+    matrix = iter(matrix)
+    first = next(matrix, None)
+    if first is None:
+        return
+    matrix = itertools.chain([first], matrix)
+
+    variables = grouping_variables(cfg, first[1])
+    if not variables:
+        yield from matrix
+        return
+
+    template = config.compile_template(cfg["general"]["params"])
+
+    # resolved parameters -> ranges of ids, in the order groups are first seen
+    groups = dict()
+    for id, state in matrix:
+        env = config.get_environment(cfg, state, id)
+        # only the variables which group instances are substituted, and the
+        # rest are left as they are
+        params = template.safe_substitute(
+            {name: env[name] for name in variables if name in env}
+        ).strip()
+
+        ranges = groups.setdefault(params, [])
+        if ranges and ranges[-1][1] + 1 == id:
+            ranges[-1][1] = id
+        else:
+            ranges.append([id, id])
+
+        yield id, state
+
+    groups_dir = cfg["root_dir"] / GROUPS_DIR
+    os.makedirs(groups_dir, exist_ok=True)
+    for old_file in groups_dir.glob("*.ids"):
+        os.remove(old_file)
+
+    cfg["groups"] = []
+    for i, (params, ranges) in enumerate(groups.items()):
+        ids_file = f"{GROUPS_DIR}/{i}.ids"
+        with open(cfg["root_dir"] / ids_file, "w") as f:
+            for first, last in ranges:
+                f.writelines(ID_RECORD.format(id) for id in range(first, last + 1))
+
+        cfg["groups"].append(
+            {
+                "params": params,
+                "ids_file": ids_file,
+                "count": sum(last - first + 1 for first, last in ranges),
+                "ids": util.format_ranges(ranges),
+            }
+        )
+
+    log.info(
+        f"Split the matrix into {len(cfg['groups'])} groups, by their #SBATCH parameters"
+    )
+
+
+@lru_cache(maxsize=64)
+def group_ids(ids):
+    """The instance ids of a group, from its compressed ranges, e.g. '0-3,8'"""
+    return tuple(util.parse_ranges(ids))
+
+
+@lru_cache(maxsize=64)
+def group_positions(ids):
+    """Map each instance id of a group to its position in the group"""
+    return {id: position for position, id in enumerate(group_ids(ids))}
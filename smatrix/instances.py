@@ -1,15 +1,162 @@
-from rich.pretty import pretty_repr
-from rich.console import Console
 import logging
 from pathlib import Path
 import glob
+import hashlib
+import itertools
 import os
-import shutil
+from string import Template
 
 from . import config
+from . import profiling
+from . import store
 
 log = logging.getLogger("smatrix")
 
+# glob matches, keyed by the templated source pattern. These are shared by every
+# instance of a matrix, as the same pattern (e.g. a common reference file) is
+# very often used by all of them
+_glob_cache = {}
+
+# compiled templates for `copies` with `template = true`, keyed by source path
+_template_cache = {}
+
+# stat results of plain `copies` sources, keyed by source path
+_stat_cache = {}
+
+
+def reset_caches():
+    """Forget anything remembered from the filesystem by a previous matrix"""
+    _glob_cache.clear()
+    _template_cache.clear()
+    _stat_cache.clear()
+    store.reset_caches()
+
+
+def load_template(path):
+    """Read and compile a template file, once per matrix"""
+    try:
+        return _template_cache[path]
+    except KeyError:
+        pass
+
+    profiling.count("read")
+    with open(path, "r") as f:
+        template = Template(f.read())
+
+    _template_cache[path] = template
+    return template
+
+
+def source_stat(path):
+    try:
+        return _stat_cache[path]
+    except KeyError:
+        pass
+
+    profiling.count("stat")
+    stat = os.stat(path)
+    _stat_cache[path] = stat
+    return stat
+
+
+def glob_resolved(pattern):
+    """Resolved matches of a (templated) glob pattern, memoised across instances"""
+    try:
+        return _glob_cache[pattern]
+    except KeyError:
+        pass
+
+    with profiling.phase("glob"):
+        profiling.count("glob")
+        matches = tuple(
+            Path(path).resolve(strict=True) for path in glob.glob(pattern)
+        )
+    if not matches:
+        raise FileNotFoundError(f"Could not find pattern '{pattern}'")
+
+    _glob_cache[pattern] = matches
+    return matches
+
+
+def preload_globs(cfg):
+    """Resolve every source pattern which is the same for all instances
+
+    This happens once, up front, so that a missing file is reported before any
+    of the matrix is created.
+    """
+    envs = config.get_environment(cfg)
+    patterns = list(cfg["symlinks"].values())
+    patterns += [options["path"] for options in cfg["copies"].values()]
+
+    for pattern in patterns:
+        if config.template_identifiers(pattern) <= {"MATRIX_NAME"}:
+            glob_resolved(config.template_envs(pattern, envs))
+
+
+def environment_file_contents(env):
+    envs = [f"{k}={v}" for k, v in env.items()]
+    return "\x00".join(envs) + "\x00"
+
+
+def parse_environment(record):
+    """The inverse of environment_file_contents"""
+    return dict(var.split("=", 1) for var in record.split("\x00") if var)
+
+
+def read_environment_file(path):
+    with open(path, "r") as f:
+        return parse_environment(f.read())
+
+
+def script_files(cfg):
+    """(name, contents) of every script, which are the same for every instance"""
+    for k, v in cfg["script"].items():
+        yield ("job_run.sh" if k == "slurm_exec" else k), v
+
+
+def scripts_digest(cfg):
+    """A hash of the scripts, which `update` keeps once for the whole matrix
+
+    Scripts aren't part of each instance's digest, so that editing one only
+    rewrites the scripts themselves, and not every instance.
+    """
+    h = hashlib.sha256()
+    for part in (cfg["general"]["store"], *itertools.chain(*script_files(cfg))):
+        h.update(str(part).encode())
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+def remove_file(path):
+    """Remove a file (or link) which smatrix wrote, if it's there"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def write_scripts(cfg, dir, replace=False):
+    """Write every script into an instance directory
+
+    With `replace`, any existing file of the same name is removed first, rather
+    than written through (which would change a blob shared through the store).
+    """
+    for name, contents in script_files(cfg):
+        dest = (dir / Path(name)).resolve()
+
+        log.debug(
+            f"[bold magenta]Write[/]\t'{dest.relative_to(dir)}'",
+            extra={"markup": True},
+        )
+
+        # make parent directory if needed
+        profiling.count("makedirs")
+        os.makedirs(dest.parent, exist_ok=True)
+
+        if replace:
+            remove_file(dest)
+        store.write_text(cfg, contents, dest)
+
 
 class Instance:
     def __init__(self, state, cfg, id):
@@ -22,6 +169,9 @@ class Instance:
 
         self.env = config.get_environment(cfg, state, id)
 
+        # filled in on demand by `plan`
+        self._plan = None
+
         # create subdirectory folder
         self.dir = self.cfg["root_dir"] / Path(
             config.template_envs(self.cfg["general"]["instance_label"], self.env)
@@ -34,40 +184,109 @@ class Instance:
             extra={"markup": True},
         )
 
-    def update_filesystem(self):
+    def update_filesystem(self, replace=False):
+        """Create the instance directory, with its symlinks and copies
+
+        With `replace`, the directory may already exist (e.g. with the outputs
+        of an earlier run), and any of this instance's files which are already
+        there are replaced.
+        """
         log.debug(f"Instance with id %d has path '%s'", self.id, self.dir)
-        os.mkdir(self.dir)
+        with profiling.phase("mkdir", self.id):
+            profiling.count("mkdir")
+            if replace:
+                os.makedirs(self.dir, exist_ok=True)
+            else:
+                os.mkdir(self.dir)
 
-        log.debug("Creating symlinks")
-        for dest_pattern, src_pattern in self.cfg["symlinks"].items():
-            for src, dest in self.search_glob(src_pattern, dest_pattern):
-                dest_rel = dest.relative_to(self.dir)
+        for kind, src, dest, templated in self.plan():
+            # ensure that the parent directory exists
+            with profiling.phase("mkdir", self.id):
+                profiling.count("makedirs")
+                os.makedirs(dest.parent, exist_ok=True)
+            if replace:
+                remove_file(dest)
+
+            dest_rel = dest.relative_to(self.dir)
+            if kind == "symlink":
                 log.debug(
                     f"[bold yellow]Symlink[/]\t'{dest_rel}' ← '{src}'",
                     extra={"markup": True},
                 )
-                os.symlink(src, dest)
-
-        log.debug("Creating copies")
-        for dest_pattern, options in self.cfg["copies"].items():
-            src_pattern = options["path"]
-            template = options["template"]
+                with profiling.phase("symlink", self.id):
+                    profiling.count("symlink")
+                    os.symlink(src, dest)
+                continue
 
-            for src, dest in self.search_glob(src_pattern, dest_pattern):
-                dest_rel = dest.relative_to(self.dir)
-                template_msg = "✓" if template else "✗"
-                log.debug(
-                    f"[bold bright_cyan]Copy[/]\t'{dest_rel}' ← '{src}' [bright_black][ Template {template_msg} ][/]",
-                    extra={"markup": True},
-                )
-                if template:
-                    with open(src, "r") as f:
-                        contents = f.read()
-                    templated = config.template_envs(contents, self.env)
+            template_msg = "✓" if templated is not None else "✗"
+            log.debug(
+                f"[bold bright_cyan]Copy[/]\t'{dest_rel}' ← '{src}' [bright_black][ Template {template_msg} ][/]",
+                extra={"markup": True},
+            )
+            with profiling.phase("copy", self.id):
+                if templated is not None:
+                    profiling.count("write")
                     with open(dest, "w") as f:
                         f.write(templated)
                 else:
-                    shutil.copy2(src, dest)
+                    store.copy_file(self.cfg, src, dest)
+
+    def plan(self):
+        """Every symlink and copy of this instance, without touching the filesystem
+
+        Each entry is (kind, src, dest, templated), where `templated` holds the
+        templated contents of a copy with `template = true`, and is otherwise None.
+        """
+        if self._plan is not None:
+            return self._plan
+
+        plan = []
+        for dest_pattern, src_pattern in self.cfg["symlinks"].items():
+            for src, dest in self.search_glob(src_pattern, dest_pattern):
+                plan.append(("symlink", src, dest, None))
+
+        for dest_pattern, options in self.cfg["copies"].items():
+            for src, dest in self.search_glob(options["path"], dest_pattern):
+                templated = None
+                if options["template"]:
+                    with profiling.phase("template", self.id):
+                        templated = load_template(src).substitute(self.env)
+                plan.append(("copy", src, dest, templated))
+
+        self._plan = plan
+        return plan
+
+    def digest(self):
+        """A hash of everything that this instance writes to the filesystem
+
+        Two instances with the same digest produce identical job directories, so
+        an instance whose digest hasn't changed doesn't need to be rewritten.
+        """
+        h = hashlib.sha256()
+
+        def add(*parts):
+            for part in parts:
+                h.update(str(part).encode())
+                h.update(b"\x00")
+
+        add(
+            self.dir.relative_to(self.cfg["root_dir"]),
+            environment_file_contents(self.env),
+            self.cfg["general"]["store"],
+        )
+
+        for kind, src, dest, templated in self.plan():
+            add(kind, src, dest.relative_to(self.dir))
+            if kind != "copy":
+                continue
+            if templated is not None:
+                add(templated)
+            else:
+                # plain copies change when their source does
+                stat = source_stat(src)
+                add(stat.st_size, stat.st_mtime_ns)
+
+        return h.hexdigest()
 
     def search_glob(self, src, dest):
         # template the source and destination
@@ -79,9 +298,7 @@ class Instance:
         # convert to Pathlib object
         dest_t = self.dir / Path(dest_t)
 
-        path_matches = list(glob.glob(src_t))
-        if not path_matches:
-            raise FileNotFoundError(f"Could not find pattern '{src_t}'")
+        path_matches = glob_resolved(src_t)
 
         # if there are multiple results, dest MUST be a directory
         if len(path_matches) > 1 and not is_dir:
@@ -94,21 +311,11 @@ class Instance:
                 + f"To avoid this warning, explicitly set the destination to '{dest}/' (currently '{dest}') in the configuration file, to indicate that you want to output to a directory."
             )
 
-        # make directory if needed
-        if is_dir:
-            os.makedirs(dest_t, exist_ok=True)
-
-        for path in path_matches:
-            # get absolute file path
-            file_src = Path(path).resolve(strict=True)
+        for file_src in path_matches:
             file_dest = (dest_t / file_src.name) if is_dir else dest_t
-
-            # ensure that the parent directory exists
-            os.makedirs(file_dest.parent, exist_ok=True)
-
             yield (file_src, file_dest)
 
-    def write_files(self):
+    def write_files(self, replace=False):
         # create environment file
         #
         # a SLURM environment file is:
@@ -121,10 +328,9 @@ class Instance:
         # $ cat job_environment | python -c 'import sys; sys.stdout.write(sys.stdin.read().replace("\0", "\n"))'
         # which will replace all null bytes with a newline.
         log.debug(f"Create environment file %s", self.env)
-        envs = [f"{k}={v}" for k, v in self.env.items()]
-        env_file_contents = "\x00".join(envs) + "\x00"
+        profiling.count("write")
         with open(self.dir / "job_environment", "w") as f:
-            f.write(env_file_contents)
+            f.write(environment_file_contents(self.env))
             log.debug(
                 f"[bold magenta]Write[/]\t'job_environment' (environment variable file)",
                 extra={"markup": True},
@@ -132,29 +338,16 @@ class Instance:
 
         # create the script files
         # an intentional design choice is to NOT use templating here, as all variables will be available to the environment
-        with open(self.dir / "job_run.sh", "w") as f:
-            f.write(self.cfg["script"]["slurm_exec"])
-            log.debug(
-                f"[bold magenta]Write[/]\t'job_run.sh' (main SLURM file to be executed)",
-                extra={"markup": True},
-            )
-
-        for k, v in self.cfg["script"].items():
-            if k == "slurm_exec":
-                continue
-            dest = (self.dir / Path(k)).resolve()
-            dest_rel = dest.relative_to(self.dir)
-
-            log.debug(
-                f"[bold magenta]Write[/]\t'{dest_rel}'",
-                extra={"markup": True},
-            )
-
-            # make parent directory if needed
-            os.makedirs(dest.parent, exist_ok=True)
+        # (with stages, each stage's script is written along with the other files)
+        write_scripts(self.cfg, self.dir, replace=replace)
 
-            with open(dest, "w") as f:
-                f.write(v)
+    def written_files(self):
+        """The files (relative to the instance directory) which smatrix writes,
+        apart from the scripts, so that `update` can replace just these"""
+        files = ["job_environment"]
+        for kind, src, dest, templated in self.plan():
+            files.append(str(dest.relative_to(self.dir)))
+        return files
 
     def report_state(self):
         return {
@@ -0,0 +1,231 @@
+import json
+import logging
+import mmap
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from rich.console import Console
+from rich.table import Table
+from rich.text import Text
+
+from . import instances
+from . import packed
+from . import slurm
+from . import util
+
+log = logging.getLogger("smatrix")
+
+# every task ends up logging to `slurm-<job id>.out` in its instance directory
+# (see slurm.TASK_LOG_PATH and slurm.REDIRECT_OUTPUT), with one file for each
+# time that it has been run
+LOG_PATTERN = re.compile(r"^slurm-(\d+)\.out$")
+
+# the matrix's own variables are already part of each instance's parameters
+HIDDEN_VARIABLES = {"MATRIX_NAME", "MATRIX_JOB_ID", "MATRIX_JOB_LABEL"}
+
+
+def find_log(matrix_path, id):
+    """The log of the latest run of an instance, or None if it hasn't run"""
+    latest = None
+    try:
+        with os.scandir(Path(matrix_path) / "jobs" / str(id)) as entries:
+            for entry in entries:
+                match = LOG_PATTERN.match(entry.name)
+                if match and (latest is None or int(match.group(1)) > latest[0]):
+                    latest = (int(match.group(1)), entry.path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return Path(latest[1]) if latest else None
+
+
+def tail_lines(path, n):
+    """The last `n` non-empty lines of a file, read backwards a block at a time"""
+    if not n:
+        return []
+
+    lines = []
+    with open(path, "rb") as f:
+        for line in util.iter_lines_backwards(f):
+            if line.strip():
+                lines.append(line)
+                if len(lines) == n:
+                    break
+
+    return [line.decode(errors="replace") for line in reversed(lines)]
+
+
+def grep_lines(path, pattern):
+    """Yield (line number, line) for each line of a file which matches `pattern`"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            line_number = 1
+            counted_to = 0
+            last_start = -1
+            for match in pattern.finditer(mm):
+                start = mm.rfind(b"\n", 0, match.start()) + 1
+                if start == last_start:
+                    # only report each line once
+                    continue
+                last_start = start
+
+                end = mm.find(b"\n", match.start())
+                if end == -1:
+                    end = len(mm)
+
+                # count the lines since the last match in place, rather than
+                # copying that part of the file to count them
+                newline = mm.find(b"\n", counted_to, start)
+                while newline != -1:
+                    line_number += 1
+                    newline = mm.find(b"\n", newline + 1, start)
+                counted_to = start
+                yield line_number, mm[start:end].decode(errors="replace")
+
+
+def read_params(matrix_path, cfg, id):
+    """The matrix parameters of an instance, from its environment file"""
+    try:
+        env = instances.read_environment_file(
+            Path(matrix_path) / "jobs" / str(id) / "job_environment"
+        )
+    except (FileNotFoundError, NotADirectoryError):
+        if cfg["general"].get("layout") != "packed":
+            return dict()
+        # packed instances which haven't run yet have no directory
+        env = packed.read_environment(matrix_path, id)
+
+    return {k: v for k, v in env.items() if k not in HIDDEN_VARIABLES}
+
+
+def scan(matrix_path, cfg, id, tail, pattern, group):
+    path = find_log(matrix_path, id)
+    result = {
+        "id": id,
+        "params": read_params(matrix_path, cfg, id),
+        "log": str(path) if path else None,
+    }
+    if path is None:
+        return result
+
+    if pattern is not None:
+        result["matches"] = list(grep_lines(path, pattern))
+    if group:
+        last = tail_lines(path, 1)
+        result["last_line"] = last[0].strip() if last else ""
+    if tail:
+        result["tail"] = tail_lines(path, tail)
+    return result
+
+
+def get_ids(args, cfg, matrix_path, job_ids):
+    """The instances to look at, in order"""
+    if args.ids:
+        ids = util.parse_ranges(args.ids)
+    else:
+        ids = range(cfg["count"])
+
+    states = slurm.get_states_arg(args)
+    if not states:
+        return list(ids)
+
+    retries = slurm.read_retries(matrix_path)
+    data = slurm.query_sacct(job_ids + slurm.retry_job_ids(retries))
+    segments = slurm.get_segments(cfg, matrix_path, job_ids, data, retries)
+    wanted = {
+        id
+        for first, last, state, start in slurm.filter_segments(segments, states)
+        for id in range(first, last + 1)
+    }
+    return [id for id in ids if id in wanted]
+
+
+def describe(result):
+    params = " ".join(f"{k}={v}" for k, v in result["params"].items())
+    return f"{result['id']} ({params})" if params else str(result["id"])
+
+
+def logs(args):
+    location = slurm.find_loc_of_executing(args)
+    if location is None:
+        return 1
+    matrix_path, job_ids = location
+    cfg = slurm.load_snapshot(matrix_path)
+
+    pattern = None
+    if args.grep:
+        flags = re.MULTILINE | (re.IGNORECASE if args.ignore_case else 0)
+        pattern = re.compile(args.grep.encode(), flags)
+    # show the end of each log, unless something else was asked for
+    tail = args.tail
+    if tail is None:
+        tail = 0 if (pattern is not None or args.group) else 10
+
+    ids = get_ids(args, cfg, matrix_path, job_ids)
+    log.info(f"Reading the logs of {len(ids)} instances of {matrix_path}")
+
+    console = Console()
+    groups = dict()
+    missing = []
+
+    # reading logs is mostly waiting on the filesystem, so many can be in flight
+    # at once. Results still come back in id order, and only a few are held at
+    # a time, however large the matrix
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        results = util.map_bounded(
+            pool,
+            lambda id: scan(matrix_path, cfg, id, tail, pattern, args.group),
+            ((id,) for id in ids),
+            window=args.jobs * 4,
+        )
+
+        for result in results:
+            if result["log"] is None:
+                missing.append(result["id"])
+                continue
+
+            if args.json:
+                print(json.dumps(result))
+                continue
+
+            if args.group:
+                groups.setdefault(result["last_line"], []).append(result["id"])
+
+            if pattern is not None:
+                for line_number, line in result["matches"]:
+                    console.print(
+                        Text.assemble(
+                            (describe(result), "bold cyan"),
+                            (f":{line_number}: ", "bright_black"),
+                            line,
+                        ),
+                        soft_wrap=True,
+                    )
+
+            if tail:
+                console.rule(Text(f"{describe(result)}  {result['log']}"))
+                for line in result["tail"]:
+                    console.print(Text(line), soft_wrap=True)
+
+    if args.group and not args.json:
+        table = Table(title="Instances by their last line of output", expand=True)
+        table.add_column("last line")
+        table.add_column("count", justify="right")
+        table.add_column("instances")
+
+        for last_line, group_ids in sorted(groups.items(), key=lambda g: -len(g[1])):
+            table.add_row(
+                Text(last_line or "(empty)"),
+                str(len(group_ids)),
+                util.format_ranges(util.compress_ids(group_ids)),
+            )
+        console.print(table)
+
+    if missing:
+        log.warning(
+            f"{len(missing)} instances have no log yet: {util.format_ranges(util.compress_ids(missing))}"
+        )
+    return 0
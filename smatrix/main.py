@@ -1,21 +1,13 @@
 import argparse
-import toml
+import importlib
 import logging
 import sys
-from rich.logging import RichHandler
 
-from . import create
-from . import default
-from . import slurm
-from . import generate
+# NB: subcommands are given as "module:function", and are only imported once
+# one of them has been chosen, so that e.g. `smatrix --help` or `smatrix ps`
+# don't pay for importing everything else
 
 FORMAT = "%(message)s"
-logging.basicConfig(
-    level="INFO",
-    format=FORMAT,
-    datefmt="[%X]",
-    handlers=[RichHandler(show_time=False, show_path=False)],
-)
 log = logging.getLogger("smatrix")
 
 top_parser = argparse.ArgumentParser(
@@ -35,7 +27,20 @@ generate_parser.add_argument(
 generate_parser.add_argument(
     "--start", action="store_true", help="Whether to immediately start the job"
 )
-generate_parser.set_defaults(func=generate.generate)
+generate_parser.add_argument(
+    "--preview",
+    type=int,
+    default=5,
+    help="Number of rows to show from the start and the end of the parameters file",
+)
+generate_parser.add_argument(
+    "--jobs",
+    "-j",
+    type=int,
+    default=1,
+    help="Number of instances to create in parallel. Useful on shared filesystems, where each file operation is slow.",
+)
+generate_parser.set_defaults(func="generate:generate")
 
 create_parser = subparsers.add_parser("create")
 create_parser.add_argument(
@@ -44,24 +49,265 @@ create_parser.add_argument(
 create_parser.add_argument(
     "--start",
     action="store_true",
-    help="Start any jobs, after the file structure has been created. Identical to running `sbatch executor.sh` from the root folder, or `smatrix start`.",
+    help="Start any jobs, after the file structure has been created. Identical to running `smatrix start` on the root folder afterwards.",
+)
+create_parser.add_argument(
+    "--jobs",
+    "-j",
+    type=int,
+    default=1,
+    help="Number of instances to create in parallel. Useful on shared filesystems, where each file operation is slow.",
+)
+create_parser.add_argument(
+    "--profile",
+    action="store_true",
+    help="Time each phase of creating the matrix and count filesystem operations, and write a report to profile.json in the root directory",
+)
+create_parser.add_argument(
+    "--cprofile",
+    action="store_true",
+    help="As --profile, and also dump cProfile stats of the main thread to profile.pstats",
+)
+create_parser.set_defaults(func="create:create")
+
+update_parser = subparsers.add_parser(
+    "update",
+    description="Apply changes in a configuration file to an existing matrix, rewriting only the instances which have changed",
+)
+update_parser.add_argument(
+    "config", type=str, help="The .toml file to configure smatrix"
+)
+update_parser.add_argument(
+    "matrix_path", type=str, help="The root directory of the matrix to update"
+)
+update_parser.add_argument(
+    "--jobs",
+    "-j",
+    type=int,
+    default=1,
+    help="Number of instances to update in parallel. Useful on shared filesystems, where each file operation is slow.",
+)
+update_parser.set_defaults(func="create:update")
+
+start_parser = subparsers.add_parser(
+    "start", description="Submit a matrix which was created without --start"
+)
+start_parser.add_argument(
+    "matrix_path", type=str, help="The root directory of the matrix to start"
 )
-create_parser.set_defaults(func=create.create)
+start_parser.set_defaults(func="slurm:start")
 
 ps_parser = subparsers.add_parser("ps", description="See status of started job matrix")
 ps_parser.add_argument(
+    "--matrix-path",
+    type=str,
+    action="append",
+    required=False,
+    help="The path of the matrix which has been started. Can be repeated, to show an overview of several matrices",
+)
+ps_parser.add_argument(
+    "--all",
+    action="store_true",
+    help="Show an overview of every started matrix below the current directory",
+)
+ps_parser.add_argument(
+    "--name",
+    type=str,
+    required=False,
+    help="Use the latest started matrix with this name, rather than the latest of any name",
+)
+ps_parser.add_argument(
+    "--state",
+    type=str,
+    action="append",
+    help="Only show instances in this state, e.g. FAILED. Can be repeated, or comma-separated",
+)
+ps_parser.add_argument(
+    "--tasks",
+    action="store_true",
+    help="Show one row for every instance, rather than a summary of each state",
+)
+ps_parser.add_argument(
+    "--watch",
+    action="store_true",
+    help="Keep the summary up to date until every instance has finished",
+)
+ps_parser.add_argument(
+    "--interval",
+    type=float,
+    default=5,
+    help="Seconds between updates with --watch, which back off while nothing changes",
+)
+ps_parser.set_defaults(func="slurm:ps")
+
+retry_parser = subparsers.add_parser(
+    "retry",
+    description="Resubmit only the array tasks of a started matrix which failed, timed out or ran out of memory",
+)
+retry_parser.add_argument(
+    "--matrix-path",
+    type=str,
+    required=False,
+    help="The path of the matrix which has been started",
+)
+retry_parser.add_argument(
+    "--name",
+    type=str,
+    required=False,
+    help="Use the latest started matrix with this name, rather than the latest of any name",
+)
+retry_parser.add_argument(
+    "--state",
+    type=str,
+    action="append",
+    help="Retry instances in this state, rather than FAILED, TIMEOUT and OUT_OF_MEMORY. Can be repeated, or comma-separated",
+)
+retry_parser.add_argument(
+    "--mem", type=str, help="Memory for the retried tasks, e.g. 8G, as for sbatch --mem"
+)
+retry_parser.add_argument(
+    "--time", type=str, help="Time limit for the retried tasks, as for sbatch --time"
+)
+retry_parser.add_argument(
+    "--dry-run",
+    action="store_true",
+    help="Show which tasks would be retried, without submitting them",
+)
+retry_parser.set_defaults(func="slurm:retry")
+
+logs_parser = subparsers.add_parser(
+    "logs",
+    description="Show, search and summarise the logs of the instances of a started matrix",
+)
+logs_parser.add_argument(
     "--matrix-path",
     type=str,
     required=False,
     help="The path of the matrix which has been started",
 )
-ps_parser.set_defaults(func=slurm.ps)
+logs_parser.add_argument(
+    "--name",
+    type=str,
+    required=False,
+    help="Use the latest started matrix with this name, rather than the latest of any name",
+)
+logs_parser.add_argument(
+    "--ids", type=str, help="Only these instances, e.g. 0-99,205"
+)
+logs_parser.add_argument(
+    "--state",
+    type=str,
+    action="append",
+    help="Only instances in this state, e.g. FAILED. Can be repeated, or comma-separated",
+)
+logs_parser.add_argument(
+    "--tail",
+    "-n",
+    type=int,
+    help="Show the last N lines of each log. Defaults to 10, unless --grep or --group is given",
+)
+logs_parser.add_argument(
+    "--grep", "-e", type=str, help="Show the lines of each log which match this regex"
+)
+logs_parser.add_argument(
+    "--ignore-case", "-i", action="store_true", help="Match --grep case-insensitively"
+)
+logs_parser.add_argument(
+    "--group",
+    action="store_true",
+    help="Group instances by the last line of their log, e.g. to see how they failed",
+)
+logs_parser.add_argument(
+    "--json",
+    action="store_true",
+    help="Print one JSON object per instance, rather than tables",
+)
+logs_parser.add_argument(
+    "--jobs",
+    "-j",
+    type=int,
+    default=16,
+    help="Number of logs to read at once",
+)
+logs_parser.set_defaults(func="logs:logs")
+
+collect_parser = subparsers.add_parser(
+    "collect",
+    description="Gather the output files of every instance into one table, alongside each instance's parameters",
+)
+collect_parser.add_argument(
+    "--matrix-path",
+    type=str,
+    required=False,
+    help="The root directory of the matrix. Defaults to the latest matrix below the current directory",
+)
+collect_parser.add_argument(
+    "--name",
+    type=str,
+    required=False,
+    help="Use the latest matrix with this name, rather than the latest of any name",
+)
+collect_parser.add_argument(
+    "--files",
+    type=str,
+    help="Glob of the files to read, relative to each instance directory, e.g. 'results/*.json'. Overrides `files` in the [collect] section of the config",
+)
+collect_parser.add_argument(
+    "--format",
+    type=str,
+    choices=["json", "csv", "kv", "text"],
+    help="How to read each file. Overrides `format` in the [collect] section of the config",
+)
+collect_parser.add_argument(
+    "--output",
+    "-o",
+    type=str,
+    help="The file to write, as JSON lines if it ends in .jsonl, and as CSV otherwise. Defaults to CSV on stdout",
+)
+collect_parser.add_argument(
+    "--jobs",
+    "-j",
+    type=int,
+    default=16,
+    help="Number of instances to read at once",
+)
+collect_parser.set_defaults(func="collect:collect")
+
+stats_parser = subparsers.add_parser(
+    "stats",
+    description="Summarise the time, CPU and memory used by a started matrix, for each value of each of its variables",
+)
+stats_parser.add_argument(
+    "--matrix-path",
+    type=str,
+    required=False,
+    help="The path of the matrix which has been started",
+)
+stats_parser.add_argument(
+    "--name",
+    type=str,
+    required=False,
+    help="Use the latest started matrix with this name, rather than the latest of any name",
+)
+stats_parser.add_argument(
+    "--state",
+    type=str,
+    action="append",
+    help="Only instances in this state, e.g. COMPLETED. Can be repeated, or comma-separated",
+)
+stats_parser.add_argument(
+    "--output",
+    "-o",
+    type=str,
+    help="Also write the usage of every instance, alongside its parameters, to this file (JSON lines if it ends in .jsonl, and CSV otherwise)",
+)
+stats_parser.set_defaults(func="stats:stats")
 
 default_parser = subparsers.add_parser(
     "default", description="Provides a default configuration file."
 )
 default_parser.add_argument("file", type=str, help="The .json path to output to")
-default_parser.set_defaults(func=default.create_default)
+default_parser.set_defaults(func="default:create_default")
 
 top_parser.add_argument(
     "--verbose",
@@ -70,9 +316,27 @@ top_parser.add_argument(
 )
 
 
+def setup_logging():
+    from rich.logging import RichHandler
+
+    logging.basicConfig(
+        level="INFO",
+        format=FORMAT,
+        datefmt="[%X]",
+        handlers=[RichHandler(show_time=False, show_path=False)],
+    )
+
+
+def run_command(target, args):
+    module_name, func_name = target.split(":")
+    module = importlib.import_module(f".{module_name}", __package__)
+    return getattr(module, func_name)(args)
+
+
 def main():
     args = top_parser.parse_args()
+    setup_logging()
     if args.verbose:
         log.setLevel("DEBUG")
 
-    sys.exit(args.func(args))
+    sys.exit(run_command(args.func, args))
@@ -0,0 +1,80 @@
+import logging
+import os
+from pathlib import Path
+
+from . import config
+from . import instances
+
+log = logging.getLogger("smatrix")
+
+# The packed layout stores every instance's environment in one file, instead of
+# creating a directory per instance up front. Each record of `environments` is
+# exactly what would have been written to that instance's `job_environment`,
+# and line i of `environments.idx` holds the byte offset and length of record i.
+#
+# Index lines are fixed width, so that the executor can seek straight to its own
+# record with `dd`. Scripts are written once, to `scripts/`, and are copied into
+# `jobs/<id>/` by the executor when the task first runs.
+ENVIRONMENTS_FILE = "environments"
+INDEX_FILE = "environments.idx"
+SCRIPTS_DIR = "scripts"
+INDEX_RECORD = "{:016d} {:016d}\n"
+INDEX_RECORD_SIZE = len(INDEX_RECORD.format(0, 0))
+
+
+def write(cfg, matrix):
+    """Write the packed environments of every (id, state) in `matrix`, returning the count"""
+    count = 0
+    offset = 0
+
+    root = cfg["root_dir"]
+    with open(root / ENVIRONMENTS_FILE, "wb") as env_f, open(
+        root / INDEX_FILE, "w"
+    ) as index_f:
+        for id, state in matrix:
+            env = config.get_environment(cfg, state, id)
+            record = instances.environment_file_contents(env).encode()
+
+            env_f.write(record)
+            index_f.write(INDEX_RECORD.format(offset, len(record)))
+
+            offset += len(record)
+            count += 1
+
+    log.debug(
+        f"[bold magenta]Write[/]\t'{ENVIRONMENTS_FILE}' ({count} packed environments)",
+        extra={"markup": True},
+    )
+
+    write_scripts(cfg)
+    return count
+
+
+def write_scripts(cfg):
+    scripts_dir = cfg["root_dir"] / SCRIPTS_DIR
+
+    for name, v in instances.script_files(cfg):
+        dest = (scripts_dir / Path(name)).resolve()
+
+        os.makedirs(dest.parent, exist_ok=True)
+        with open(dest, "w") as f:
+            f.write(v)
+
+        log.debug(
+            f"[bold magenta]Write[/]\t'{dest.relative_to(cfg['root_dir'])}'",
+            extra={"markup": True},
+        )
+
+
+def read_environment(root_dir, id):
+    """Read the environment of a single instance back from a packed matrix"""
+    root_dir = Path(root_dir)
+    with open(root_dir / INDEX_FILE, "r") as f:
+        f.seek(id * INDEX_RECORD_SIZE)
+        offset, length = map(int, f.read(INDEX_RECORD_SIZE).split())
+
+    with open(root_dir / ENVIRONMENTS_FILE, "rb") as f:
+        f.seek(offset)
+        record = f.read(length).decode()
+
+    return instances.parse_environment(record)
@@ -0,0 +1,214 @@
+import contextlib
+import json
+import logging
+import statistics
+import threading
+import time
+from collections import Counter, defaultdict
+
+log = logging.getLogger("smatrix")
+
+# `create --profile` times each phase of creating a matrix, for each instance
+# and in total, and counts the filesystem operations it makes. The report is
+# written to the root of the matrix, so that runs on different storage can be
+# compared.
+#
+# Phases don't overlap: time spent in a phase which starts inside another (e.g.
+# globbing while planning a digest) is only counted once, towards the inner one.
+# With --jobs, the totals are summed over every thread, so they can add up to
+# more than the wall time.
+REPORT_FILE = "profile.json"
+INSTANCES_FILE = "profile_instances.tsv"
+CPROFILE_FILE = "profile.pstats"
+
+# the profiler of the current command, or None when not profiling, in which case
+# everything below does as little as possible
+_profiler = None
+
+_NO_PHASE = contextlib.nullcontext()
+
+
+class Profiler:
+    def __init__(self, cprofile=False):
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+        # phase -> [calls, seconds]
+        self.phases = defaultdict(lambda: [0, 0.0])
+        # id -> phase -> seconds
+        self.instances = defaultdict(lambda: defaultdict(float))
+        self.ops = Counter()
+
+        self.cprofile = None
+        if cprofile:
+            # NB: this only sees the main thread, so is best used without --jobs
+            import cProfile
+
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    @contextlib.contextmanager
+    def phase(self, name, id=None):
+        stack = self.local.__dict__.setdefault("stack", [])
+        now = time.perf_counter()
+
+        # pause whichever phase this is nested in
+        if stack:
+            self.add(stack[-1], now)
+        entry = [name, id, now]
+        stack.append(entry)
+
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self.add(entry, now, calls=1)
+            stack.pop()
+            if stack:
+                stack[-1][2] = now
+
+    def add(self, entry, now, calls=0):
+        name, id, since = entry
+        elapsed = now - since
+        with self.lock:
+            totals = self.phases[name]
+            totals[0] += calls
+            totals[1] += elapsed
+            if id is not None:
+                self.instances[id][name] += elapsed
+        entry[2] = now
+
+    def count(self, op, n=1):
+        with self.lock:
+            self.ops[op] += n
+
+    def report(self, cfg, jobs=1):
+        wall = time.perf_counter() - self.start
+        count = cfg.get("count") or 0
+
+        phases = dict()
+        for name, (calls, seconds) in self.phases.items():
+            phase = {"calls": calls, "total_s": round(seconds, 6)}
+
+            per_instance = [
+                (times[name], id) for id, times in self.instances.items() if name in times
+            ]
+            if per_instance:
+                values = sorted(seconds for seconds, _ in per_instance)
+                slowest = max(per_instance)
+                phase["per_instance"] = {
+                    "instances": len(values),
+                    "mean_s": round(statistics.fmean(values), 9),
+                    "median_s": round(statistics.median(values), 9),
+                    "p95_s": round(values[int(0.95 * (len(values) - 1))], 9),
+                    "max_s": round(slowest[0], 9),
+                    "max_id": slowest[1],
+                }
+            phases[name] = phase
+
+        return {
+            "name": cfg["general"]["name"],
+            "root": str(cfg["root_dir"]),
+            "instances": count,
+            "jobs": jobs,
+            "store": cfg["general"]["store"],
+            "layout": cfg["general"]["layout"],
+            "wall_s": round(wall, 6),
+            "phases": phases,
+            "fs_ops": dict(self.ops),
+            "fs_ops_per_instance": {
+                op: round(n / count, 3) for op, n in self.ops.items() if count
+            },
+        }
+
+
+def start(cprofile=False):
+    global _profiler
+    _profiler = Profiler(cprofile=cprofile)
+
+
+def phase(name, id=None):
+    """Time the enclosed block as `name`, for instance `id` if given"""
+    if _profiler is None:
+        return _NO_PHASE
+    return _profiler.phase(name, id)
+
+
+def count(op, n=1):
+    """Count a filesystem operation"""
+    if _profiler is not None:
+        _profiler.count(op, n)
+
+
+def finish(cfg, jobs=1):
+    """Stop profiling, and write the report into the root of the matrix"""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is None:
+        return None
+
+    root = cfg["root_dir"]
+    if profiler.cprofile is not None:
+        profiler.cprofile.disable()
+        profiler.cprofile.dump_stats(root / CPROFILE_FILE)
+
+    report = profiler.report(cfg, jobs=jobs)
+    with open(root / REPORT_FILE, "w") as f:
+        json.dump(report, f, indent=2)
+
+    # only the phases which are timed for each instance
+    phases = sorted(
+        name for name, phase in report["phases"].items() if "per_instance" in phase
+    )
+    with open(root / INSTANCES_FILE, "w") as f:
+        f.write("\t".join(["id", *phases]) + "\n")
+        for id in sorted(profiler.instances):
+            times = profiler.instances[id]
+            f.write(
+                "\t".join([str(id), *(f"{times.get(name, 0):.9f}" for name in phases)])
+                + "\n"
+            )
+
+    print_report(report)
+    log.info(f"Wrote profile to '{root / REPORT_FILE}'")
+    return report
+
+
+def print_report(report):
+    from rich.console import Console
+    from rich.table import Table
+
+    wall = report["wall_s"]
+    table = Table(
+        title=f"Profile of {report['instances']} instances ({wall:.2f}s)", expand=True
+    )
+    table.add_column("Phase")
+    table.add_column("Total", justify="right")
+    table.add_column("% of wall", justify="right")
+    table.add_column("Calls", justify="right")
+    table.add_column("Mean / instance", justify="right")
+    table.add_column("Max / instance", justify="right")
+
+    phases = sorted(report["phases"].items(), key=lambda p: -p[1]["total_s"])
+    for name, phase in phases:
+        per_instance = phase.get("per_instance")
+        table.add_row(
+            name,
+            f"{phase['total_s']:.3f}s",
+            f"{100 * phase['total_s'] / wall:.1f}%" if wall else "-",
+            str(phase["calls"]),
+            f"{per_instance['mean_s'] * 1e3:.3f}ms" if per_instance else "",
+            f"{per_instance['max_s'] * 1e3:.3f}ms (#{per_instance['max_id']})"
+            if per_instance
+            else "",
+        )
+
+    ops = ", ".join(
+        f"{op} {n} ({report['fs_ops_per_instance'].get(op, 0)}/instance)"
+        for op, n in sorted(report["fs_ops"].items())
+    )
+    if ops:
+        table.caption = f"Filesystem operations: {ops}"
+
+    Console().print(table)
@@ -0,0 +1,132 @@
+import json
+import logging
+import os
+import shlex
+from datetime import datetime
+from pathlib import Path
+
+from . import util
+
+log = logging.getLogger("smatrix")
+
+# An append-only log of every matrix which has been created or submitted, one
+# JSON record per line, so that "the latest matrix" can be found by reading the
+# end of one file instead of searching the filesystem for job_id files.
+REGISTRY_ENV = "SMATRIX_REGISTRY"
+
+
+def get_registry_path():
+    if os.environ.get(REGISTRY_ENV):
+        return Path(os.environ[REGISTRY_ENV])
+
+    state_home = os.environ.get("XDG_STATE_HOME") or Path.home() / ".local" / "state"
+    return Path(state_home) / "smatrix" / "registry.jsonl"
+
+
+def record(event, cfg, job_ids=None):
+    """Append an event ("create" or "submit") for the matrix described by `cfg`"""
+    entry = {
+        "event": event,
+        "root": str(cfg["root_dir"]),
+        "name": cfg["general"]["name"],
+        "count": cfg["count"],
+        "job_ids": [int(job_id) for job_id in job_ids or []],
+        "time": datetime.now().isoformat(timespec="seconds"),
+    }
+
+    path = get_registry_path()
+    try:
+        os.makedirs(path.parent, exist_ok=True)
+        # a single small write in append mode, so that concurrent writers don't
+        # interleave their records
+        with open(path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+    except OSError as err:
+        # the registry is only ever a shortcut, so never fail because of it
+        log.debug(f"Could not write to the matrix registry at '{path}': {err}")
+
+
+def record_command(event, cfg, job_id_var):
+    """A shell command which appends a record like `record` does, for a job ID
+    which is only known once the job runs, from the variable `job_id_var`"""
+    entry = {
+        "event": event,
+        "root": str(cfg["root_dir"]),
+        "name": cfg["general"]["name"],
+        "count": cfg["count"],
+        "job_ids": "JOB_IDS",
+        "time": "TIME",
+    }
+    # as a printf format
+    line = (
+        json.dumps(entry)
+        .replace("\\", "\\\\")
+        .replace("%", "%%")
+        .replace('"JOB_IDS"', "[%s]")
+        .replace('"TIME"', '"%s"')
+        + "\\n"
+    )
+    return (
+        f'printf {shlex.quote(line)} "${job_id_var}" "$(date +%Y-%m-%dT%H:%M:%S)"'
+        f" >> {shlex.quote(str(get_registry_path()))} 2>/dev/null || true"
+    )
+
+
+def iter_records():
+    """Yield every record in the registry, newest first"""
+    path = get_registry_path()
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return
+
+    with f:
+        # recent records are at the end, so they're found without reading the
+        # whole registry
+        for line in util.iter_lines_backwards(f):
+            entry = _parse(line)
+            if entry:
+                yield entry
+
+
+def _parse(line):
+    if not line.strip():
+        return None
+    try:
+        return json.loads(line)
+    except ValueError:
+        # e.g. a partially written record
+        return None
+
+
+def find_matrices(name=None, under=None, submitted=False):
+    """Yield the roots of matching matrices which still exist, newest first
+
+    Each root is only yielded once, for its newest record. With `submitted`,
+    only matrices which have been started are yielded. A matrix started by hand
+    with sbatch is recorded by its executor, once its first task runs.
+    """
+    under = Path(under).resolve() if under is not None else None
+    seen = set()
+
+    for entry in iter_records():
+        root = Path(entry["root"])
+        if root in seen:
+            continue
+        if name is not None and entry["name"] != name:
+            continue
+        if submitted and entry["event"] != "submit":
+            continue
+        if under is not None and under != root and under not in root.parents:
+            continue
+
+        seen.add(root)
+        if root.exists():
+            yield root, entry
+
+
+def find_latest(name=None, under=None, submitted=False):
+    """The root of the newest matching matrix, or None"""
+    for root, entry in find_matrices(name=name, under=under, submitted=submitted):
+        return root
+    return None
@@ -3,17 +3,22 @@ import subprocess
 import re
 import json
 import logging
-import copy
+import os
+import textwrap
+import time
+from datetime import datetime
 
-from rich.console import Console
-from rich.table import Table
-from rich.text import Text
+from . import config
+from . import groups
+from . import packed
+from . import registry
+from .util import compress_ids, format_ranges, parse_ranges
 
 log = logging.getLogger("smatrix")
 
 MAIN_EXECUTOR_HEADER = """#!/bin/bash
-#SBATCH --error=jobs/%a/slurm-%A.out
-#SBATCH --output=jobs/%a/slurm-%A.out
+#SBATCH --error={log_path}
+#SBATCH --output={log_path}
 #SBATCH --chdir={root_dir}
 #SBATCH --array=0-{count_m_1}{concurrent}
 """
@@ -22,22 +27,235 @@ MAIN_EXECUTOR_BODY = """
 set -e
 
 cd {root_dir}
-echo $SLURM_ARRAY_JOB_ID > job_id
-cd jobs/$SLURM_ARRAY_TASK_ID/
-source load_env.sh
+{record_job_id}MATRIX_TASK_ID={instance_id}
+{setup}{redirect_output}source load_env.sh
 
-sh job_run.sh
+sh {run_script}
 """
 
+# with `pack`, each array task runs a block of several instances
+BLOCK_EXECUTOR_BODY = """
+cd {root_dir} || exit
+{record_job_id}
+# the id of the instance at a position of this array
+instance_id() {{
+    echo {instance_id}
+}}
+
+# runs a single instance, in its own subshell so that instances don't share
+# their environments
+run_instance() (
+    set -e
+
+    MATRIX_TASK_ID=$1
+{setup}{redirect_output}    source load_env.sh
+
+    sh {run_script}
+)
+
+# this array task runs the instances at positions FIRST to LAST
+FIRST=$((SLURM_ARRAY_TASK_ID * {pack} + {offset}))
+LAST=$((FIRST + {pack} - 1))
+[ $LAST -le {last_position} ] || LAST={last_position}
+{run_block}
+# report the exit code of every instance, and fail if any of them failed
+failed=0
+for ((position = FIRST; position <= LAST; position++)); do
+    id=$(instance_id $position)
+    code=$(cat jobs/$id/exit_code 2>/dev/null || echo missing)
+    echo "Instance $id exited with status $code"
+    [ "$code" = 0 ] || failed=$((failed + 1))
+done
+[ $failed -eq 0 ]
+"""
+
+RUN_BLOCK_SEQUENTIAL = """
+for ((position = FIRST; position <= LAST; position++)); do
+    id=$(instance_id $position)
+    rm -f jobs/$id/exit_code
+    run_instance $id
+    echo $? > jobs/$id/exit_code
+done
+"""
+
+RUN_BLOCK_PARALLEL = """
+# run as many instances at once as there are CPUs allocated to the task
+for ((position = FIRST; position <= LAST; position++)); do
+    id=$(instance_id $position)
+    while [ "$(jobs -rp | wc -l)" -ge "${SLURM_CPUS_PER_TASK:-1}" ]; do
+        wait -n
+    done
+    rm -f jobs/$id/exit_code
+    { run_instance $id; echo $? > jobs/$id/exit_code; } &
+done
+wait
+"""
+
+INSTANCE_SETUP = """cd jobs/$MATRIX_TASK_ID/
+"""
+
+# in the packed layout, task directories are only made when each task runs
+PACKED_INSTANCE_SETUP = """mkdir -p jobs/$MATRIX_TASK_ID/
+cd jobs/$MATRIX_TASK_ID/
+
+# unpack this task's environment and scripts, the first time that it runs
+if [ ! -e job_environment ]; then
+    read -r offset length < <(dd if={root_dir}/{index_file} bs={index_record_size} skip=$MATRIX_TASK_ID count=1 status=none)
+    tail -c +$((10#$offset + 1)) {root_dir}/{environments_file} | head -c $((10#$length)) > job_environment
+    cp -R {root_dir}/{scripts_dir}/. .
+fi
+"""
+
+# an array's task ids are positions within its instances. Without groups, the
+# position is the instance id; otherwise, the id is read from the group's ids
+# file (see groups.py)
+POSITION_INSTANCE_ID = "$(({position}))"
+GROUP_INSTANCE_ID = "$((10#$(dd if={root_dir}/{ids_file} bs={record_size} skip=$(({position})) count=1 status=none)))"
+
+# only a matrix submitted as a single array records its own job ID; otherwise,
+# each array would overwrite the others. The first task to start also records
+# the submission in the registry, as it may have been submitted by hand with
+# sbatch. Retries are recorded separately, by `smatrix retry`
+RECORD_JOB_ID = """if [ -z "$SMATRIX_RETRY" ] && [ "$(cat job_id 2>/dev/null)" != "$SLURM_ARRAY_JOB_ID" ]; then
+    echo $SLURM_ARRAY_JOB_ID > job_id
+    {record_submit}
+fi
+"""
+
+# SLURM can only log straight into the task directory when it already exists,
+# and when the array index is the instance id. Otherwise, it logs to a shared
+# directory, until the task redirects its own output
+TASK_LOG_PATH = "jobs/%a/slurm-%A.out"
+SHARED_LOG_PATH = "logs/slurm-%A_%a.out"
+REDIRECT_OUTPUT = "exec >> slurm-$SLURM_ARRAY_JOB_ID.out 2>&1\n"
+
 
 class SlurmException(Exception):
     pass
 
 
 assert MAIN_EXECUTOR_BODY.startswith("\n")
+assert BLOCK_EXECUTOR_BODY.startswith("\n")
 assert MAIN_EXECUTOR_HEADER.endswith("\n")
 
 
+def get_max_array_size(cfg):
+    """The largest array that can be submitted, or None if there is no limit"""
+    if cfg["general"]["max_array_size"]:
+        return cfg["general"]["max_array_size"]
+
+    # ask SLURM, if it's available
+    try:
+        result = subprocess.run(
+            ["scontrol", "show", "config"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (FileNotFoundError, subprocess.CalledProcessError):
+        return None
+
+    match = re.search(r"^MaxArraySize\s*=\s*(\d+)", result.stdout, re.MULTILINE)
+    return int(match.group(1)) if match else None
+
+
+def plan_arrays(cfg):
+    """Split the matrix into as many arrays as the cluster's MaxArraySize requires
+
+    Array indices must be below MaxArraySize, so each array covers the instances
+    at positions `offset` to `offset + instances - 1`. With `pack`, each of the
+    `tasks` array tasks runs a block of `pack` consecutive positions.
+
+    Without groups, an instance's position is its id. Otherwise, each group of
+    instances with the same #SBATCH parameters gets arrays of its own, whose
+    positions are within the ids of that `group`.
+    """
+    pack = cfg["general"]["pack"]
+    max_size = get_max_array_size(cfg)
+
+    if cfg.get("groups"):
+        counts = [(i, group["count"]) for i, group in enumerate(cfg["groups"])]
+    else:
+        counts = [(None, cfg["count"])]
+
+    arrays = []
+    for group, count in counts:
+        tasks = -(-count // pack)
+        step = min(max_size or tasks, tasks)
+        for first_task in range(0, tasks, step):
+            offset = first_task * pack
+            array_tasks = min(step, tasks - first_task)
+            array = {
+                "offset": offset,
+                "tasks": array_tasks,
+                "instances": min(array_tasks * pack, count - offset),
+            }
+            if group is not None:
+                array["group"] = group
+            arrays.append(array)
+
+    if len(arrays) == 1:
+        arrays[0]["script"] = "executor.sh"
+        return arrays
+
+    for i, array in enumerate(arrays):
+        array["script"] = f"executor_{i}.sh"
+
+    if cfg.get("groups"):
+        log.info(
+            f"Submitting {len(cfg['groups'])} groups of instances as {len(arrays)} arrays"
+        )
+    else:
+        log.info(
+            f"Splitting {-(-cfg['count'] // pack)} array tasks into {len(arrays)} arrays, as the maximum array size is {max_size}"
+        )
+    return arrays
+
+
+def get_arrays(cfg):
+    # snapshots from older versions of smatrix always have a single array
+    return cfg.get(
+        "arrays",
+        [
+            {
+                "script": "executor.sh",
+                "offset": 0,
+                "tasks": cfg["count"],
+                "instances": cfg["count"],
+            }
+        ],
+    )
+
+
+def get_array_ids(cfg, array, first, stop):
+    """The ids of the instances at positions `first` to `stop - 1` of an array"""
+    if array.get("group") is None:
+        return range(first, stop)
+    return groups.group_ids(cfg["groups"][array["group"]]["ids"])[first:stop]
+
+
+def get_instance_position(cfg, array, id):
+    """The position of an instance within an array's group, or None"""
+    if array.get("group") is None:
+        return id
+    return groups.group_positions(cfg["groups"][array["group"]]["ids"]).get(id)
+
+
+def get_task_instances(cfg, array, task_id):
+    """The ids of the instances run by one task of an array"""
+    pack = cfg["general"].get("pack", 1)
+    first = array["offset"] + task_id * pack
+    last = min(first + pack, array["offset"] + array["instances"])
+    return get_array_ids(cfg, array, first, last)
+
+
+def as_ranges(ids):
+    """Split ids into ranges of consecutive ids"""
+    if isinstance(ids, range):
+        return [ids] if ids else []
+    return [range(first, last + 1) for first, last in compress_ids(ids)]
+
+
 def create_supplementary_files(cfg):
     # parameters = "\n".join("#SBATCH " + x for x in cfg["general"]["params"])
     parameters = cfg["general"]["params"].strip()
@@ -47,116 +265,1028 @@ def create_supplementary_files(cfg):
     else:
         concurrent = ""
 
-    with open(cfg["root_dir"] / "executor.sh", "w") as f:
-        f.write(
-            MAIN_EXECUTOR_HEADER.format(
-                count_m_1=cfg["count"] - 1, concurrent=concurrent, **cfg
+    cfg["arrays"] = plan_arrays(cfg)
+    if cfg.get("stages"):
+        # every stage runs the same arrays, with executors of its own
+        cfg["arrays"] = [
+            {
+                **array,
+                "stage": stage,
+                "script": array["script"].replace("executor", f"executor_{stage}", 1),
+            }
+            for stage in cfg["stages"]
+            for array in cfg["arrays"]
+        ]
+    single_array = len(cfg["arrays"]) == 1
+    record_job_id = ""
+    if single_array:
+        record_job_id = RECORD_JOB_ID.format(
+            record_submit=registry.record_command(
+                "submit", cfg, "SLURM_ARRAY_JOB_ID"
             )
-            + parameters
-            + MAIN_EXECUTOR_BODY.format(**cfg)
         )
+    pack = cfg["general"]["pack"]
+
+    # remove executors left behind by a previous layout of this matrix
+    scripts = {array["script"] for array in cfg["arrays"]}
+    for old_script in cfg["root_dir"].glob("executor*.sh"):
+        if old_script.name not in scripts:
+            os.remove(old_script)
+
+    if cfg["general"]["layout"] == "packed":
+        setup = PACKED_INSTANCE_SETUP.format(
+            environments_file=packed.ENVIRONMENTS_FILE,
+            index_file=packed.INDEX_FILE,
+            index_record_size=packed.INDEX_RECORD_SIZE,
+            scripts_dir=packed.SCRIPTS_DIR,
+            **cfg,
+        )
+    else:
+        setup = INSTANCE_SETUP
+
+    for array in cfg["arrays"]:
+        if array.get("stage") is None:
+            run_script = "job_run.sh"
+        else:
+            run_script = config.stage_script(array["stage"])
+
+        group = array.get("group")
+        if group is None:
+            array_parameters = parameters
+            instance_id = POSITION_INSTANCE_ID
+        else:
+            array_parameters = cfg["groups"][group]["params"]
+            instance_id = GROUP_INSTANCE_ID.format(
+                root_dir=cfg["root_dir"],
+                ids_file=cfg["groups"][group]["ids_file"],
+                record_size=groups.ID_RECORD_SIZE,
+                position="{position}",
+            )
+
+        if (
+            cfg["general"]["layout"] == "directories"
+            and group is None
+            and array["offset"] == 0
+            and pack == 1
+        ):
+            log_path = TASK_LOG_PATH
+            redirect_output = ""
+        else:
+            log_path = SHARED_LOG_PATH
+            redirect_output = REDIRECT_OUTPUT
+            os.makedirs(cfg["root_dir"] / Path(log_path).parent, exist_ok=True)
+
+        if pack == 1:
+            body = MAIN_EXECUTOR_BODY.format(
+                record_job_id=record_job_id,
+                redirect_output=redirect_output,
+                instance_id=instance_id.format(
+                    position=f"SLURM_ARRAY_TASK_ID + {array['offset']}"
+                ),
+                setup=setup,
+                run_script=run_script,
+                **cfg,
+            )
+        else:
+            body = BLOCK_EXECUTOR_BODY.format(
+                record_job_id=record_job_id,
+                redirect_output=textwrap.indent(redirect_output, "    "),
+                instance_id=instance_id.format(position="$1"),
+                offset=array["offset"],
+                setup=textwrap.indent(setup, "    "),
+                pack=pack,
+                last_position=array["offset"] + array["instances"] - 1,
+                run_block=RUN_BLOCK_PARALLEL
+                if cfg["general"]["pack_mode"] == "parallel"
+                else RUN_BLOCK_SEQUENTIAL,
+                run_script=run_script,
+                **cfg,
+            )
+
+        with open(cfg["root_dir"] / array["script"], "w") as f:
+            f.write(
+                MAIN_EXECUTOR_HEADER.format(
+                    count_m_1=array["tasks"] - 1,
+                    concurrent=concurrent,
+                    log_path=log_path,
+                    **cfg,
+                )
+                + array_parameters
+                + body
+            )
+
+    # a streamed matrix (e.g. from a CSV file) is gone once it has been created
+    snapshot = cfg
+    if not isinstance(cfg["matrix"], (dict, list)):
+        snapshot = {**cfg, "matrix": None}
 
     with open(cfg["root_dir"] / "matrix_config_snapshot.json", "w") as f:
-        json.dump(cfg, f, default=str)
+        json.dump(snapshot, f, default=str)
+
 
+def execute_batch(cfg, tasks=None, extra_args=(), event="submit"):
+    """Submit every array of the matrix, returning their job IDs in order
+
+    With `tasks`, a dict of array script to a list of task ids, only those
+    arrays are submitted, and each only runs the given tasks. `extra_args` are
+    passed on to sbatch, and override the executor's own #SBATCH options.
+
+    With stages, each task of a stage's array waits for the same task of the
+    previous stage's array to succeed (if that was submitted too), so an
+    instance moves on to its next stage without waiting for the others.
+    """
+    job_ids = []
+    # the job ID of the last array submitted for each stage, and for each part
+    # of the matrix that arrays cover
+    last_of_stage = dict()
+    last_of_part = dict()
+    for array in get_arrays(cfg):
+        command = ["sbatch", *extra_args]
+        stage = array.get("stage")
+        part = (array.get("group"), array["offset"])
+
+        if tasks is not None:
+            if not tasks.get(array["script"]):
+                continue
+            concurrent = cfg["general"]["concurrent"]
+            command.append(
+                f"--array={format_ranges(compress_ids(tasks[array['script']]))}"
+                + (f"%{concurrent}" if concurrent else "")
+            )
+
+        # the concurrency limit only applies within an array, so to respect it
+        # across the whole matrix, each array waits for the previous one
+        dependencies = []
+        if stage in last_of_stage and cfg["general"]["concurrent"]:
+            dependencies.append(f"afterany:{last_of_stage[stage]}")
+        if stage is not None and part in last_of_part:
+            dependencies.append(f"aftercorr:{last_of_part[part]}")
+        if dependencies:
+            command.append(f"--dependency={','.join(dependencies)}")
+
+        result = subprocess.run(
+            command + [cfg["root_dir"] / array["script"]],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        match = re.match(
+            r"^Submitted batch job (\d+)\n$", result.stdout, re.MULTILINE
+        )
+        if not match:
+            raise SlurmException(result.stdout + result.stderr)
+
+        job_ids.append(match.group(1))
+        last_of_stage[stage] = job_ids[-1]
+        last_of_part[part] = job_ids[-1]
+
+    registry.record(event, cfg, job_ids)
+    return job_ids
+
+
+def read_job_ids(matrix_path):
+    """The job ID of each array of a started matrix, in order"""
+    with open(Path(matrix_path) / "job_id", "r") as f:
+        return [int(line) for line in f.read().split()]
+
+
+def write_job_ids(matrix_path, job_ids):
+    with open(Path(matrix_path) / "job_id", "w") as f:
+        f.write("".join(f"{job_id}\n" for job_id in job_ids))
+
+
+# one line for each retry of a started matrix, of the retry's job ID, the job ID
+# of the array it retries, and the (compressed) ids of the tasks it reruns
+RETRY_JOB_ID_FILE = "retry_job_id"
+
+
+def read_retries(matrix_path):
+    """Every retry of a started matrix, oldest first"""
+    retries = []
+    try:
+        with open(Path(matrix_path) / RETRY_JOB_ID_FILE, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                job_id, array_job_id, task_ids = line.split()
+                retries.append(
+                    {
+                        "job_id": int(job_id),
+                        "array_job_id": int(array_job_id),
+                        "tasks": parse_ranges(task_ids),
+                    }
+                )
+    except FileNotFoundError:
+        pass
+    return retries
+
+
+def write_retry(matrix_path, job_id, array_job_id, task_ids):
+    with open(Path(matrix_path) / RETRY_JOB_ID_FILE, "a") as f:
+        f.write(f"{job_id} {array_job_id} {format_ranges(compress_ids(task_ids))}\n")
+
+
+def retry_job_ids(retries):
+    return [retry["job_id"] for retry in retries]
+
+
+def find_matrix(args, submitted=True):
+    """The root of the matrix given on the command line, or of the latest one"""
+    matrix_path = args.matrix_path
+    if isinstance(matrix_path, list):
+        matrix_path = matrix_path[0] if matrix_path else None
+    if not matrix_path:
+        matrix_path = registry.find_latest(
+            name=getattr(args, "name", None), under=".", submitted=submitted
+        )
+
+    if not matrix_path and not getattr(args, "name", None):
+        # matrices which were started before the registry existed can still
+        # be found by searching for their job_id files
+        log.info("No started matrix found in the registry, searching for one")
+        matrix_path = search_loc_of_executing()
+
+    if not matrix_path:
+        log.error(
+            "Could not find valid job. Please manually provide one with '--matrix-path <ROOT_DIR>'. The job ID can be found in the job_id folder of the root directory."
+        )
+        return None
+
+    return Path(matrix_path)
+
+
+def find_loc_of_executing(args):
+    matrix_path = find_matrix(args)
+    if matrix_path is None:
+        return None
+    try:
+        return matrix_path, read_job_ids(matrix_path)
+    except FileNotFoundError:
+        log.error(
+            f"The matrix at '{matrix_path}' hasn't been started. Start it with `smatrix start {matrix_path}`."
+        )
+        return None
+
+
+def search_loc_of_executing():
+    """Find the matrix with the newest job ID below the current directory"""
+    return newest_job(job_f.parent for job_f in Path(".").glob("**/job_id"))
+
+
+def newest_job(roots):
+    """The root of the started matrix with the newest job ID, or None"""
+    matrix_path = None
+    job_id = 0
+
+    for root in roots:
+        try:
+            new_job_ids = read_job_ids(root)
+            if new_job_ids and max(new_job_ids) > job_id:
+                job_id = max(new_job_ids)
+                matrix_path = root
+        except (OSError, ValueError):
+            pass
+
+    return matrix_path
+
+
+def query_sacct(job_ids):
+    # with -j, sacct looks back as far as it needs to for those jobs, so there's
+    # no need for a --starttime
+    command = ["sacct", "-j", ",".join(map(str, job_ids)), "--json"]
 
-def execute_batch(cfg):
     result = subprocess.run(
-        ["sbatch", cfg["root_dir"] / "executor.sh"],
+        command,
         capture_output=True,
         text=True,
         check=True,
     )
-    groups = re.match(r"^Submitted batch job (\d+)\n$", result.stdout, re.MULTILINE)
-    if not groups:
-        raise SlurmException(result.stdout + result.stderr)
+    return json.loads(result.stdout)
 
-    job_id = groups.group(1)
-    return job_id
 
+def load_snapshot(matrix_path):
+    with open(Path(matrix_path) / "matrix_config_snapshot.json", "r") as f:
+        return json.load(f)
 
-def find_loc_of_executing(args):
-    matrix_path = args.matrix_path
-    if not matrix_path:
-        # find it using path
-        found = False
-        matrix_path = None
-        job_id = 0
-
-        for job_f in Path(".").glob("**/job_id"):
-            with open(job_f, "r") as f:
-                try:
-                    new_job_id = int(f.read())
-                    if new_job_id > job_id:
-                        job_id = new_job_id
-                        matrix_path = job_f.parent
-                    found = True
-                except ValueError:
-                    pass
-        if not found:
-            log.error(
-                "Could not find valid job. Please manually provide one with '--job-id <JOB_ID>'. The job ID can be found in the job_id folder of the root directory."
+
+def iter_task_states(cfg, matrix_path, job_ids, data, include_pending=True):
+    """Yield (ids, state, start) for each of sacct's records of the matrix
+
+    `ids` is a range of consecutive instance ids, so a record can be split over
+    several ranges when its array is of a group. Tasks which haven't started yet
+    are covered by the rest of their array, unless `include_pending` is False.
+    """
+    # each array's task ids are relative to the start of that array
+    arrays = {job_id: array for job_id, array in zip(job_ids, get_arrays(cfg))}
+    last_idx = {job_id: -1 for job_id in arrays}
+    packed_tasks = cfg["general"].get("pack", 1) > 1
+
+    for job in data["jobs"]:
+        array_job_id = job["array"]["job_id"]
+        array = arrays.get(array_job_id)
+        if array is None:
+            continue
+
+        state = " ".join(job["state"]["current"])
+        start = job["time"]["start"]
+
+        if job["array"]["task_id"]["set"]:
+            task_id = job["array"]["task_id"]["number"]
+            last_idx[array_job_id] = task_id
+            ids = get_task_instances(cfg, array, task_id)
+
+            if packed_tasks:
+                # instances which share a task can each succeed or fail
+                for id in ids:
+                    id_state = get_packed_state(matrix_path, id, state)
+                    yield range(id, id + 1), id_state, start
+                continue
+        elif include_pending:
+            # the remaining tasks of the array haven't started yet
+            first_task = last_idx[array_job_id] + 1
+            if first_task >= array["tasks"]:
+                continue
+            ids = get_array_ids(
+                cfg,
+                array,
+                array["offset"] + first_task * cfg["general"].get("pack", 1),
+                array["offset"] + array["instances"],
             )
-            return 1
-    else:
-        with open(matrix_path / Path("job_id"), "r") as f:
-            job_id = int(f.read())
-    return matrix_path, job_id
+        else:
+            continue
+
+        for id_range in as_ranges(ids):
+            yield id_range, state, start
+
+
+def get_stage_views(cfg, job_ids):
+    """Split a matrix into (stage, cfg, job ids) for each of its stages, in order
+
+    Each stage's cfg only has that stage's arrays, so it can be treated as a
+    matrix of its own. A matrix without stages is a single view, of stage None.
+    """
+    if not cfg.get("stages"):
+        return [(None, cfg, job_ids)]
+
+    views = []
+    for stage in cfg["stages"]:
+        pairs = [
+            (job_id, array)
+            for job_id, array in zip(job_ids, get_arrays(cfg))
+            if array.get("stage") == stage
+        ]
+        views.append(
+            (
+                stage,
+                {**cfg, "stages": None, "arrays": [array for _, array in pairs]},
+                [job_id for job_id, _ in pairs],
+            )
+        )
+    return views
+
+
+def combine_stages(count, stage_segments):
+    """Reduce the segments of each stage to one list of segments
+
+    An instance has the state of its first stage which hasn't completed, or of
+    its last stage once every stage has, along with the name of that stage.
+    """
+    states = [None] * count
+    last_stage = stage_segments[-1][0]
+    # later stages are overwritten by any earlier stage which isn't done
+    for stage, segments in reversed(stage_segments):
+        for first, last, state, start in segments:
+            if stage == last_stage or "COMPLETED" not in state.split():
+                states[first : last + 1] = [(f"{state} ({stage})", start)] * (
+                    last - first + 1
+                )
+
+    combined = []
+    for id, (state, start) in enumerate(states):
+        if combined and combined[-1][2:] == (state, start):
+            combined[-1] = (combined[-1][0], id, state, start)
+        else:
+            combined.append((id, id, state, start))
+    return combined
+
+
+def get_segments(cfg, matrix_path, job_ids, data, retries=()):
+    """Reduce sacct's records to a compact list of (first, last, state, start)
+
+    Each segment is a run of consecutive instance ids which share a state, so a
+    whole pending array is a single segment rather than one row per task. Any
+    instances which sacct doesn't know about are reported as UNKNOWN, and any
+    which have been retried have the state of their latest retry.
+    """
+    if cfg.get("stages"):
+        return combine_stages(
+            cfg["count"],
+            [
+                (stage, get_segments(view, matrix_path, view_job_ids, data, retries))
+                for stage, view, view_job_ids in get_stage_views(cfg, job_ids)
+            ],
+        )
+
+    segments = [
+        (ids.start, ids.stop - 1, state, start)
+        for ids, state, start in iter_task_states(cfg, matrix_path, job_ids, data)
+    ]
+    segments.sort()
+
+    # fill in any gaps
+    filled = []
+    next_id = 0
+    for segment in segments:
+        if segment[0] > next_id:
+            filled.append((next_id, segment[0] - 1, "UNKNOWN", None))
+        filled.append(segment)
+        next_id = max(next_id, segment[1] + 1)
+    if next_id < cfg["count"]:
+        filled.append((next_id, cfg["count"] - 1, "UNKNOWN", None))
+
+    if retries:
+        filled = apply_retry_states(
+            filled, get_retry_states(cfg, matrix_path, job_ids, data, retries)
+        )
+    return filled
+
+
+def get_retry_states(cfg, matrix_path, job_ids, data, retries):
+    """Map each retried instance to the (state, start) of its latest retry"""
+    arrays = {job_id: array for job_id, array in zip(job_ids, get_arrays(cfg))}
+    packed_tasks = cfg["general"].get("pack", 1) > 1
+
+    records = dict()
+    for job in data["jobs"]:
+        records.setdefault(job["array"]["job_id"], []).append(job)
+
+    states = dict()
+    for retry in retries:
+        array = arrays.get(retry["array_job_id"])
+        if array is None:
+            continue
+
+        # a retry's task ids are the same as those of the array it retries
+        waiting = set(retry["tasks"])
+        waiting_state = ("UNKNOWN", None)
+        for job in records.get(retry["job_id"], []):
+            state = " ".join(job["state"]["current"])
+            start = job["time"]["start"]
+
+            if not job["array"]["task_id"]["set"]:
+                # covers whichever of the retried tasks haven't started
+                waiting_state = (state, start)
+                continue
+
+            task_id = job["array"]["task_id"]["number"]
+            waiting.discard(task_id)
+            for id in get_task_instances(cfg, array, task_id):
+                if packed_tasks:
+                    states[id] = (get_packed_state(matrix_path, id, state), start)
+                else:
+                    states[id] = (state, start)
+
+        for task_id in waiting:
+            for id in get_task_instances(cfg, array, task_id):
+                states[id] = waiting_state
+
+    return states
+
+
+def apply_retry_states(segments, states):
+    """Split `segments` wherever an instance has a state from a retry"""
+    if not states:
+        return segments
+
+    ids = sorted(states)
+    i = 0
+    split = []
+    for first, last, state, start in segments:
+        next_id = first
+        while i < len(ids) and ids[i] <= last:
+            id = ids[i]
+            i += 1
+            if id < first:
+                continue
+            if id > next_id:
+                split.append((next_id, id - 1, state, start))
+            split.append((id, id, *states[id]))
+            next_id = id + 1
+        if next_id <= last:
+            split.append((next_id, last, state, start))
+
+    # merge runs of retried instances which ended up in the same state
+    merged = []
+    for segment in split:
+        previous = merged[-1] if merged else None
+        if (
+            previous
+            and previous[1] + 1 == segment[0]
+            and previous[2:] == segment[2:]
+        ):
+            merged[-1] = (previous[0], segment[1], segment[2], segment[3])
+        else:
+            merged.append(segment)
+    return merged
+
+
+def get_packed_state(matrix_path, id, state):
+    """Use the exit code of an instance which shares its array task with others"""
+    if "PENDING" in state:
+        # any exit code is left over from an earlier run
+        return state
+
+    try:
+        with open(Path(matrix_path) / "jobs" / str(id) / "exit_code", "r") as f:
+            code = f.read().strip()
+    except (FileNotFoundError, NotADirectoryError):
+        return state
+
+    return "COMPLETED" if code == "0" else "FAILED"
+
+
+def filter_segments(segments, states):
+    if not states:
+        return segments
+    return [
+        segment
+        for segment in segments
+        if any(state in segment[2].split() for state in states)
+    ]
+
+
+def summarise_segments(segments):
+    """Map each state to its number of instances and their (first, last) ranges"""
+    summary = dict()
+    for first, last, state, start in segments:
+        count, ranges = summary.setdefault(state, [0, []])
+        summary[state][0] = count + last - first + 1
+
+        # merge with the previous range where they touch
+        if ranges and ranges[-1][1] + 1 == first:
+            ranges[-1] = (ranges[-1][0], last)
+        else:
+            ranges.append((first, last))
+    return summary
+
+
+def style_state(state):
+    from rich.text import Text
+
+    status = Text(state)
+
+    # add colour
+    if "FAILED" in state:
+        status.stylize("bold red")
+    elif "COMPLETED" in state:
+        status.stylize("bright_green")
+    elif "RUNNING" in state:
+        status.stylize("magenta")
+
+    return status
+
+
+def get_states_arg(args):
+    states = []
+    for state in getattr(args, "state", None) or []:
+        states += [s.strip().upper() for s in state.split(",") if s.strip()]
+    return states
 
 
 def ps(args):
-    matrix_path, job_id = find_loc_of_executing(args)
+    if args.all or len(args.matrix_path or []) > 1:
+        return ps_overview(args)
+
+    location = find_loc_of_executing(args)
+    if location is None:
+        return 1
+    matrix_path, job_ids = location
 
     log.info(f"Using matrix at location {matrix_path}")
 
+    cfg = load_snapshot(matrix_path)
+    retries = read_retries(matrix_path)
+    if args.watch:
+        return watch(args, cfg, matrix_path, job_ids, retries)
+
+    data = query_sacct(job_ids + retry_job_ids(retries))
+    segments = get_segments(cfg, matrix_path, job_ids, data, retries)
+    segments = filter_segments(segments, get_states_arg(args))
+
+    from rich.console import Console
+    from rich.table import Table
+
+    job_id = ", ".join(map(str, job_ids))
+    console = Console()
+
+    if args.tasks:
+        table = Table(title=f"Instances for matrix job {job_id}", expand=True)
+
+        table.add_column("id")
+        table.add_column("status")
+        table.add_column("start")
+
+        for first, last, state, start in segments:
+            status = style_state(state)
+            for id in range(first, last + 1):
+                table.add_row(str(id), status, str(start))
+
+        console.print(table)
+        return 0
+
+    console.print(summary_table(f"Summary of matrix job {job_id}", segments))
+    return 0
+
+
+def start(args):
+    """Submit a matrix which was created without --start
+
+    Matrices split into several arrays (or stages) depend on the order and
+    dependencies that execute_batch gives them, so they can't just be submitted
+    with sbatch by hand.
+    """
+    matrix_path = Path(args.matrix_path).resolve()
+    try:
+        cfg = load_snapshot(matrix_path)
+    except FileNotFoundError:
+        log.error(f"'{matrix_path}' does not contain a matrix")
+        return 1
+    if (matrix_path / "job_id").exists():
+        log.error(
+            f"The matrix at '{matrix_path}' has already been started. Use `smatrix retry` to rerun its failed instances."
+        )
+        return 1
+
+    cfg["root_dir"] = matrix_path
+    job_ids = execute_batch(cfg)
+    write_job_ids(matrix_path, job_ids)
+    log.info(
+        f"[bold yellow]Started matrix with job ID {', '.join(job_ids)}[/]",
+        extra={"markup": True},
+    )
+    return 0
+
+
+# the states which `smatrix retry` reruns, unless told otherwise
+RETRY_STATES = ["FAILED", "TIMEOUT", "OUT_OF_MEMORY"]
+
+
+def retry(args):
+    """Resubmit only the array tasks whose instances failed"""
+    location = find_loc_of_executing(args)
+    if location is None:
+        return 1
+    matrix_path, job_ids = location
+
+    cfg = load_snapshot(matrix_path)
+    cfg["root_dir"] = Path(matrix_path).resolve()
+
+    retries = read_retries(matrix_path)
+    data = query_sacct(job_ids + retry_job_ids(retries))
+    states = get_states_arg(args) or RETRY_STATES
+
+    # the tasks to rerun, for each array. With `pack`, a task reruns every
+    # instance in its block. With stages, an instance reruns the stage which
+    # failed and every stage after it, so each stage that instances restart
+    # from is submitted as a chain of its own, whose arrays run the same tasks
+    scripts = {job_id: array["script"] for job_id, array in zip(job_ids, get_arrays(cfg))}
+    views = get_stage_views(cfg, job_ids)
+    chains = []
+    retried_ids = set()
+    for i, (stage, view, view_job_ids) in enumerate(views):
+        tasks = dict()
+        segments = get_segments(view, matrix_path, view_job_ids, data, retries)
+        for first, last, state, start in filter_segments(segments, states):
+            for id in range(first, last + 1):
+                if id in retried_ids:
+                    continue
+                retried_ids.add(id)
+                for _, later_view, later_job_ids in views[i:]:
+                    job_id, task_id = get_instance_task(later_view, later_job_ids, id)
+                    tasks.setdefault(scripts[job_id], set()).add(task_id)
+        if tasks:
+            chains.append(tasks)
+
+    if not chains:
+        log.info("There are no instances to retry")
+        return 0
+
+    extra_args = ["--export=ALL,SMATRIX_RETRY=1"]
+    if args.mem:
+        extra_args.append(f"--mem={args.mem}")
+    if args.time:
+        extra_args.append(f"--time={args.time}")
+
+    for tasks in chains:
+        for script, task_ids in tasks.items():
+            log.info(
+                f"Retrying tasks {format_ranges(compress_ids(task_ids))} of '{script}'"
+            )
+    if args.dry_run:
+        log.warning("Not submitting anything, as --dry-run was passed")
+        return 0
+
+    all_new_job_ids = []
+    for tasks in chains:
+        new_job_ids = execute_batch(
+            cfg, tasks=tasks, extra_args=extra_args, event="retry"
+        )
+        all_new_job_ids += new_job_ids
+
+        # execute_batch submits arrays in order, skipping any without tasks
+        retried = [job_id for job_id in job_ids if scripts[job_id] in tasks]
+        for new_job_id, job_id in zip(new_job_ids, retried):
+            write_retry(matrix_path, new_job_id, job_id, tasks[scripts[job_id]])
+
+    task_count = sum(len(task_ids) for tasks in chains for task_ids in tasks.values())
+    log.info(
+        f"[bold yellow]Retrying {len(retried_ids)} instances in {task_count} tasks, with job ID {', '.join(all_new_job_ids)}[/]",
+        extra={"markup": True},
+    )
+    return 0
+
+
+def summary_table(title, segments):
+    from rich.table import Table
+
+    table = Table(title=title, expand=True)
+
+    table.add_column("status")
+    table.add_column("count", justify="right")
+    table.add_column("instances")
+
+    for state, (count, ranges) in summarise_segments(segments).items():
+        table.add_row(style_state(state), str(count), format_ranges(ranges))
+
+    return table
+
+
+# states after which a task will never change again (unless it's requeued)
+FINAL_STATES = {
+    "COMPLETED",
+    "FAILED",
+    "CANCELLED",
+    "TIMEOUT",
+    "OUT_OF_MEMORY",
+    "NODE_FAIL",
+    "PREEMPTED",
+    "BOOT_FAIL",
+    "DEADLINE",
+}
+
+# `ps --watch` keeps the state of every instance here between polls, so that a
+# new watch can pick up where the last one left off
+WATCH_CACHE_FILE = ".ps_cache.json"
+MAX_WATCH_INTERVAL = 120
+
+# above this many finished tasks, one query for the whole matrix is cheaper than
+# naming each task
+MAX_TARGETED_TASKS = 500
+
+
+def is_final(state):
+    return any(s in FINAL_STATES for s in state.split())
+
+
+def query_squeue(job_ids):
+    """Yield (array job id, task id, state) for every task still in the queue"""
     result = subprocess.run(
-        ["sacct", "-j", str(job_id), "--json"],
+        ["squeue", "-h", "-r", "-j", ",".join(map(str, job_ids)), "-o", "%F %K %T"],
         capture_output=True,
         text=True,
         check=True,
     )
-    data = json.loads(result.stdout)
+    for line in result.stdout.splitlines():
+        parts = line.split()
+        if len(parts) != 3 or not parts[0].isdigit() or not parts[1].isdigit():
+            continue
+        yield int(parts[0]), int(parts[1]), parts[2]
 
-    with open(matrix_path / "matrix_config_snapshot.json", "r") as f:
-        cfg = json.load(f)
 
-    jobs = []
-    current_idx = 0
-    for job in data["jobs"]:
-        if job["array"]["task_id"]["set"]:
-            current_idx = job["array"]["task_id"]["number"]
-            jobs.append(job)
+def get_instance_task(cfg, job_ids, id):
+    """The (array job id, task id) which runs an instance"""
+    pack = cfg["general"].get("pack", 1)
+    for job_id, array in zip(job_ids, get_arrays(cfg)):
+        position = get_instance_position(cfg, array, id)
+        if position is None:
+            continue
+        if array["offset"] <= position < array["offset"] + array["instances"]:
+            return job_id, (position - array["offset"]) // pack
+    raise ValueError(f"Instance {id} is not in any array")
+
+
+def states_to_segments(states):
+    segments = []
+    for id, state in enumerate(states):
+        if segments and segments[-1][2] == state:
+            segments[-1] = (segments[-1][0], id, state, None)
         else:
-            for i in range(current_idx + 1, cfg["count"]):
-                new_job = copy.deepcopy(job)
-                new_job["array"]["task_id"]["set"] = True
-                new_job["array"]["task_id"]["number"] = i
+            segments.append((id, id, state, None))
+    return segments
 
-                jobs.append(new_job)
 
-    table = Table(title=f"Instances for matrix job {job_id}", expand=True)
+def read_watch_cache(cfg, matrix_path, job_ids):
+    try:
+        with open(Path(matrix_path) / WATCH_CACHE_FILE, "r") as f:
+            cache = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
 
-    table.add_column("id")
-    table.add_column("status")
-    table.add_column("start")
+    if cache.get("job_ids") != list(job_ids):
+        return None
 
-    for job in jobs:
-        id = str(job["array"]["task_id"]["number"])
-        start = str(job["time"]["start"])
+    states = [None] * cfg["count"]
+    for first, last, state, start in cache["segments"]:
+        states[first : last + 1] = [state] * (last - first + 1)
+    return states if None not in states else None
 
-        status_raw = " ".join(job["state"]["current"])
-        # status_raw = job["state"]["current"]
-        status = Text(status_raw)
 
-        # add colour
-        if "FAILED" in status_raw:
-            status.stylize("bold red")
-        elif "COMPLETED" in status_raw:
-            status.stylize("bright_green")
-        elif "RUNNING" in status_raw:
-            status.stylize("magenta")
+def write_watch_cache(matrix_path, job_ids, states):
+    path = Path(matrix_path) / WATCH_CACHE_FILE
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump({"job_ids": list(job_ids), "segments": states_to_segments(states)}, f)
+    os.replace(tmp, path)
 
-        table.add_row(id, status, start)
 
-    console = Console()
-    console.print(table)
+def poll_states(cfg, matrix_path, job_ids, states, retries=()):
+    """Bring `states` up to date, returning whether anything changed
+
+    Queued and running tasks come from the cheap `squeue`. `sacct` is only asked
+    about instances which have left the queue since the last poll.
+    """
+    if retries or cfg.get("stages"):
+        # a retried instance can be in the queue under several job ids, as can
+        # an instance with several stages, so just ask sacct about everything
+        data = query_sacct(job_ids + retry_job_ids(retries))
+        changed = False
+        for first, last, state, start in get_segments(
+            cfg, matrix_path, job_ids, data, retries
+        ):
+            for id in range(first, last + 1):
+                if states[id] != state:
+                    states[id] = state
+                    changed = True
+        return changed
+
+    arrays = {job_id: array for job_id, array in zip(job_ids, get_arrays(cfg))}
+
+    queued = dict()
+    for array_job_id, task_id, state in query_squeue(job_ids):
+        array = arrays.get(array_job_id)
+        if array is None:
+            continue
+        for id in get_task_instances(cfg, array, task_id):
+            queued[id] = state
+
+    changed = False
+    for id, state in queued.items():
+        if states[id] != state:
+            states[id] = state
+            changed = True
+
+    finished = {
+        id
+        for id, state in enumerate(states)
+        if not is_final(state) and id not in queued
+    }
+    if not finished:
+        return changed
+
+    tasks = sorted({get_instance_task(cfg, job_ids, id) for id in finished})
+    if len(tasks) > MAX_TARGETED_TASKS:
+        data = query_sacct(job_ids)
+    else:
+        data = query_sacct([f"{job_id}_{task_id}" for job_id, task_id in tasks])
+
+    for ids, state, start in iter_task_states(
+        cfg, matrix_path, job_ids, data, include_pending=False
+    ):
+        for id in ids:
+            if id in finished and states[id] != state:
+                states[id] = state
+                changed = True
+
+    return changed
+
+
+def watch(args, cfg, matrix_path, job_ids, retries=()):
+    from rich.live import Live
+
+    job_id = ", ".join(map(str, job_ids))
+    filter_states = get_states_arg(args)
+    # the cache is only valid for the same submission and retries
+    cache_key = job_ids + retry_job_ids(retries)
+
+    states = read_watch_cache(cfg, matrix_path, cache_key)
+    if states is None:
+        states = [None] * cfg["count"]
+        data = query_sacct(cache_key)
+        segments = get_segments(cfg, matrix_path, job_ids, data, retries)
+        for first, last, state, start in segments:
+            states[first : last + 1] = [state] * (last - first + 1)
+    else:
+        poll_states(cfg, matrix_path, job_ids, states, retries)
+
+    def render():
+        segments = filter_segments(states_to_segments(states), filter_states)
+        updated = datetime.now().strftime("%H:%M:%S")
+        return summary_table(
+            f"Summary of matrix job {job_id} (updated {updated})", segments
+        )
+
+    # poll quickly while things are changing, and back off while they aren't
+    interval = args.interval
+    try:
+        with Live(render(), auto_refresh=False) as live:
+            while True:
+                write_watch_cache(matrix_path, cache_key, states)
+                live.update(render(), refresh=True)
+
+                if all(is_final(state) for state in states):
+                    break
+
+                time.sleep(interval)
+                if poll_states(cfg, matrix_path, job_ids, states, retries):
+                    interval = args.interval
+                else:
+                    interval = min(interval * 2, MAX_WATCH_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+def find_started_matrices(args):
+    """The roots of every matrix given on the command line, or every started one"""
+    if args.matrix_path and not args.all:
+        return [Path(path) for path in args.matrix_path]
+
+    return [
+        root
+        for root, entry in registry.find_matrices(
+            name=getattr(args, "name", None), under=".", submitted=True
+        )
+    ]
+
+
+def ps_overview(args):
+    """Show the status of several matrices, from a single sacct query"""
+    matrices = []
+    for root in find_started_matrices(args):
+        try:
+            matrices.append(
+                (root, read_job_ids(root), load_snapshot(root), read_retries(root))
+            )
+        except (FileNotFoundError, ValueError) as err:
+            log.warning(f"Skipping matrix at '{root}': {err}")
+
+    if not matrices:
+        log.error("Could not find any started matrices")
+        return 1
+
+    all_job_ids = [
+        job_id
+        for root, job_ids, cfg, retries in matrices
+        for job_id in job_ids + retry_job_ids(retries)
+    ]
+    data = query_sacct(all_job_ids)
+
+    filter_states = get_states_arg(args)
+    rows = []
+    states = []
+    for root, job_ids, cfg, retries in matrices:
+        # records of the other matrices are ignored, as their job ids don't match
+        segments = get_segments(cfg, root, job_ids, data, retries)
+        segments = filter_segments(segments, filter_states)
+
+        counts = {
+            state: count for state, (count, ranges) in summarise_segments(segments).items()
+        }
+        for state in counts:
+            if state not in states:
+                states.append(state)
+        rows.append((root, job_ids, cfg, counts))
+
+    from rich.console import Console
+    from rich.table import Table
+
+    table = Table(title=f"Summary of {len(matrices)} matrices", expand=True)
+    table.add_column("name")
+    table.add_column("path")
+    table.add_column("job")
+    table.add_column("count", justify="right")
+    for state in states:
+        table.add_column(style_state(state), justify="right")
+
+    for root, job_ids, cfg, counts in rows:
+        table.add_row(
+            cfg["general"]["name"],
+            str(root),
+            ", ".join(map(str, job_ids)),
+            str(cfg["count"]),
+            *(str(counts.get(state, "")) for state in states),
+        )
+
+    Console().print(table)
+    return 0
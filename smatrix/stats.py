@@ -0,0 +1,322 @@
+import logging
+import math
+import re
+import statistics
+import subprocess
+
+from rich.console import Console
+from rich.table import Table
+
+from . import collect
+from . import slurm
+from . import util
+
+log = logging.getLogger("smatrix")
+
+# `smatrix stats` asks sacct for these, for every task of the matrix at once.
+# Memory is only reported for each step (e.g. `1234_5.batch`), so each task's
+# MaxRSS is the largest of its steps
+SACCT_FIELDS = [
+    "JobID",
+    "State",
+    "Elapsed",
+    "TotalCPU",
+    "AllocCPUS",
+    "MaxRSS",
+    "ReqMem",
+]
+
+JOB_ID_PATTERN = re.compile(r"^(\d+)_(\d+)(?:\.(.+))?$")
+
+SIZE_UNITS = {"K": 1 / 1024, "M": 1, "G": 1024, "T": 1024 * 1024}
+
+# an axis with more values than this (e.g. a random seed) isn't summarised
+MAX_AXIS_VALUES = 50
+
+# how much to add to the largest usage seen, when suggesting resources
+HEADROOM = 1.2
+
+
+def parse_duration(s):
+    """Seconds in a SLURM duration, e.g. 1-02:03:04, 02:03:04, 03:04.567"""
+    if not s or s in ("INVALID", "UNLIMITED"):
+        return None
+    days, _, rest = s.rpartition("-")
+    seconds = 0.0
+    for part in rest.split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds + int(days or 0) * 86400
+
+
+def parse_size(s):
+    """MB in a SLURM memory size, e.g. 123456K or 4G"""
+    match = re.match(r"^([\d.]+)([KMGT]?)", s or "")
+    if not match:
+        return None
+    return float(match.group(1)) * SIZE_UNITS.get(match.group(2) or "M", 1)
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return ""
+    seconds = int(math.ceil(seconds))
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return (f"{days}-" if days else "") + f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+
+def format_size(mb):
+    if mb is None:
+        return ""
+    return f"{mb / 1024:.1f}G" if mb >= 1024 else f"{mb:.0f}M"
+
+
+def query_accounting(job_ids):
+    """Yield (array job id, task id, fields) for every task and step of the jobs"""
+    command = [
+        "sacct",
+        "-j",
+        ",".join(map(str, job_ids)),
+        "--parsable2",
+        "--noheader",
+        f"--format={','.join(SACCT_FIELDS)}",
+    ]
+
+    result = subprocess.run(command, capture_output=True, text=True, check=True)
+    for line in result.stdout.splitlines():
+        fields = dict(zip(SACCT_FIELDS, line.split("|")))
+        # pending tasks are listed as e.g. 1234_[5-99], and have no usage yet
+        match = JOB_ID_PATTERN.match(fields.get("JobID", ""))
+        if match:
+            yield int(match.group(1)), int(match.group(2)), match.group(3), fields
+
+
+def get_task_usage(records):
+    """Combine the records of each task and its steps into one set of metrics"""
+    tasks = dict()
+    for job_id, task_id, step, fields in records:
+        usage = tasks.setdefault((job_id, task_id), {"max_rss_mb": None})
+
+        rss = parse_size(fields["MaxRSS"])
+        if rss is not None:
+            usage["max_rss_mb"] = max(usage["max_rss_mb"] or 0, rss)
+        if step is not None:
+            continue
+
+        cpus = int(fields["AllocCPUS"] or 0)
+        req_mem = fields["ReqMem"]
+        mem_mb = parse_size(req_mem)
+        if mem_mb is not None and req_mem.endswith("c"):
+            # older versions of SLURM report memory per CPU
+            mem_mb *= max(cpus, 1)
+
+        usage.update(
+            {
+                "state": fields["State"].split()[0] if fields["State"] else "UNKNOWN",
+                "elapsed_s": parse_duration(fields["Elapsed"]),
+                "cpu_s": parse_duration(fields["TotalCPU"]),
+                "cpus": cpus,
+                "req_mem_mb": mem_mb,
+            }
+        )
+
+    for usage in tasks.values():
+        elapsed = usage.get("elapsed_s")
+        cpu = usage.get("cpu_s")
+        cpus = usage.get("cpus")
+        usage["cpu_efficiency"] = (
+            cpu / (elapsed * cpus) if elapsed and cpu is not None and cpus else None
+        )
+        rss, mem = usage["max_rss_mb"], usage.get("req_mem_mb")
+        usage["mem_efficiency"] = rss / mem if rss is not None and mem else None
+
+    return tasks
+
+
+def get_instance_usage(cfg, job_ids, retries, tasks):
+    """Map each instance id to the usage of the latest run of its task"""
+    arrays = {job_id: array for job_id, array in zip(job_ids, slurm.get_arrays(cfg))}
+    # retries reuse the task ids of the array they retry, and are newer
+    attempts = [(job_id, job_id) for job_id in job_ids]
+    attempts += [(retry["job_id"], retry["array_job_id"]) for retry in retries]
+
+    instances = dict()
+    for attempt_job_id, array_job_id in attempts:
+        array = arrays.get(array_job_id)
+        if array is None:
+            continue
+        for task_id in range(array["tasks"]):
+            usage = tasks.get((attempt_job_id, task_id))
+            if usage is None or "state" not in usage:
+                continue
+            for id in slurm.get_task_instances(cfg, array, task_id):
+                instances[id] = {
+                    "job_id": f"{attempt_job_id}_{task_id}",
+                    **usage,
+                }
+    return instances
+
+
+METRICS = [
+    "elapsed_s",
+    "cpu_s",
+    "cpus",
+    "cpu_efficiency",
+    "max_rss_mb",
+    "req_mem_mb",
+    "mem_efficiency",
+]
+
+
+def iter_rows(matrix_path, cfg, instances, states):
+    """Yield a flat row for each instance with usage: its parameters, then its metrics"""
+    for id, env in collect.iter_environments(matrix_path, cfg):
+        usage = instances.get(id)
+        if usage is None or (states and usage["state"] not in states):
+            continue
+        yield {
+            "id": id,
+            "job_id": usage["job_id"],
+            "state": usage["state"],
+            **{k: v for k, v in env.items() if not k.startswith("MATRIX_")},
+            **{metric: usage.get(metric) for metric in METRICS},
+        }
+
+
+def values(rows, metric):
+    return [row[metric] for row in rows if row[metric] is not None]
+
+
+def median_or_none(numbers):
+    return statistics.median(numbers) if numbers else None
+
+
+def axis_tables(rows, axes):
+    tables = []
+    for axis in axes:
+        groups = dict()
+        for row in rows:
+            groups.setdefault(str(row.get(axis)), []).append(row)
+        if len(groups) < 2 or len(groups) > MAX_AXIS_VALUES:
+            # nothing to compare, or too many values to be useful
+            continue
+
+        table = Table(title=f"Usage by {axis}", expand=True)
+        table.add_column("value")
+        table.add_column("n", justify="right")
+        table.add_column("elapsed (min / median / max)", justify="right")
+        table.add_column("CPU eff.", justify="right")
+        table.add_column("MaxRSS (median / max)", justify="right")
+        table.add_column("mem eff.", justify="right")
+
+        for value, group in groups.items():
+            elapsed = sorted(values(group, "elapsed_s"))
+            rss = sorted(values(group, "max_rss_mb"))
+            cpu_eff = values(group, "cpu_efficiency")
+            mem_eff = values(group, "mem_efficiency")
+
+            table.add_row(
+                value,
+                str(len(group)),
+                " / ".join(
+                    format_duration(v)
+                    for v in (elapsed[0], median_or_none(elapsed), elapsed[-1])
+                )
+                if elapsed
+                else "",
+                f"{median_or_none(cpu_eff):.0%}" if cpu_eff else "",
+                f"{format_size(median_or_none(rss))} / {format_size(rss[-1])}"
+                if rss
+                else "",
+                f"{median_or_none(mem_eff):.0%}" if mem_eff else "",
+            )
+        tables.append(table)
+    return tables
+
+
+def suggest(rows):
+    """Resources which would have fit every instance, with some headroom"""
+    suggestions = []
+
+    rss = values(rows, "max_rss_mb")
+    if rss:
+        suggestions.append(f"--mem={format_size(max(rss) * HEADROOM)}")
+
+    elapsed = values(rows, "elapsed_s")
+    if elapsed:
+        suggestions.append(f"--time={format_duration(max(elapsed) * HEADROOM)}")
+
+    # the number of CPUs that were actually kept busy
+    busy = [
+        r["cpu_s"] / r["elapsed_s"]
+        for r in rows
+        if r["cpu_s"] is not None and r["elapsed_s"]
+    ]
+    if busy:
+        suggestions.append(f"--cpus-per-task={max(1, math.ceil(max(busy)))}")
+
+    return suggestions
+
+
+def stats(args):
+    location = slurm.find_loc_of_executing(args)
+    if location is None:
+        return 1
+    matrix_path, job_ids = location
+    cfg = slurm.load_snapshot(matrix_path)
+    retries = slurm.read_retries(matrix_path)
+
+    # as with `ps`, sacct finds every task of the given jobs, however old
+    records = query_accounting(job_ids + slurm.retry_job_ids(retries))
+    usage = get_task_usage(records)
+
+    # each stage of a matrix is summarised on its own, as they're usually
+    # nothing alike
+    states = slurm.get_states_arg(args)
+    stages = dict()
+    for stage, view, view_job_ids in slurm.get_stage_views(cfg, job_ids):
+        instances = get_instance_usage(view, view_job_ids, retries, usage)
+        stages[stage] = [
+            row if stage is None else {"stage": stage, **row}
+            for row in iter_rows(matrix_path, view, instances, states)
+        ]
+
+    rows = [row for stage_rows in stages.values() for row in stage_rows]
+    if not rows:
+        log.error("No instances have any accounting information yet")
+        return 1
+
+    if cfg["general"].get("pack", 1) > 1:
+        log.warning(
+            "Instances are packed into array tasks, so each instance is shown with the usage of its whole task"
+        )
+
+    console = Console()
+    axes = [
+        k
+        for k in rows[0]
+        if k not in ("stage", "id", "job_id", "state") and k not in METRICS
+    ]
+    for stage, stage_rows in stages.items():
+        if not stage_rows:
+            continue
+        if stage is not None:
+            console.rule(f"Stage {stage}")
+
+        for table in axis_tables(stage_rows, ["state"] + axes):
+            console.print(table)
+
+        suggestions = suggest(
+            [row for row in stage_rows if row["state"] == "COMPLETED"] or stage_rows
+        )
+        if suggestions:
+            console.print(
+                f"Based on {len(stage_rows)} instances, the next run could use: [bold]{' '.join(suggestions)}[/]"
+            )
+
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            util.write_rows(f, rows, jsonl=util.is_jsonl(args.output))
+        log.info(f"Wrote {len(rows)} rows to '{args.output}'")
+    return 0
@@ -0,0 +1,138 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+
+from . import profiling
+
+log = logging.getLogger("smatrix")
+
+# How files which are identical across instances (scripts, untemplated copies)
+# are placed into each instance directory:
+#   copy      - a plain, independent copy per instance (no store is used)
+#   hardlink  - a hard link to a single blob in the store
+#   symlink   - a symbolic link to a single blob in the store
+#   reflink   - a copy-on-write clone of the blob, where the filesystem supports
+#               it, and a plain copy otherwise
+STORE_MODES = ("copy", "hardlink", "symlink", "reflink")
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+# digests of copy sources, keyed by resolved source path, and the digests of the
+# blobs which are known to be in the store
+_source_digests = {}
+_blobs = set()
+
+
+def reset_caches():
+    _source_digests.clear()
+    _blobs.clear()
+
+
+def store_dir(cfg):
+    return cfg["root_dir"] / ".store"
+
+
+def write_text(cfg, contents, dest):
+    """Write `contents` to `dest`, deduplicating it through the store if enabled"""
+    if cfg["general"]["store"] == "copy":
+        profiling.count("write")
+        with open(dest, "w") as f:
+            f.write(contents)
+        return
+
+    data = contents.encode()
+    digest = hashlib.sha256(data).hexdigest()
+    blob = store_dir(cfg) / digest
+
+    if digest not in _blobs:
+        if not blob.exists():
+
+            def write(tmp):
+                with open(tmp, "wb") as f:
+                    f.write(data)
+
+            _add_blob(blob, write)
+        _blobs.add(digest)
+
+    _place(cfg, blob, dest)
+
+
+def copy_file(cfg, src, dest):
+    """Copy `src` to `dest`, deduplicating it through the store if enabled"""
+    if cfg["general"]["store"] == "copy":
+        profiling.count("copy")
+        shutil.copy2(src, dest)
+        return
+
+    try:
+        digest = _source_digests[src]
+    except KeyError:
+        digest = _hash_file(src)
+        _source_digests[src] = digest
+    blob = store_dir(cfg) / digest
+
+    if digest not in _blobs:
+        if not blob.exists():
+            _add_blob(blob, lambda tmp: shutil.copy2(src, tmp))
+        _blobs.add(digest)
+
+    _place(cfg, blob, dest)
+
+
+def _hash_file(path):
+    profiling.count("hash")
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _add_blob(blob, write):
+    profiling.count("store_blob")
+    os.makedirs(blob.parent, exist_ok=True)
+
+    # write to a temporary name first, so that concurrent writers of the same
+    # blob never see a partial file
+    tmp = blob.with_name(f"{blob.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    write(tmp)
+
+    # blobs are shared between instances, so editing one in place (through a
+    # hard link, say) would silently change every instance
+    mode = os.stat(tmp).st_mode
+    os.chmod(tmp, mode & ~0o222)
+    os.replace(tmp, blob)
+
+    log.debug(
+        f"[bold magenta]Store[/]\t'{blob.name}'",
+        extra={"markup": True},
+    )
+
+
+def _place(cfg, blob, dest):
+    mode = cfg["general"]["store"]
+    profiling.count(mode)
+    if mode == "hardlink":
+        os.link(blob, dest)
+    elif mode == "symlink":
+        os.symlink(blob, dest)
+    elif mode == "reflink":
+        _reflink(blob, dest)
+    else:
+        raise ValueError(f"Unknown store mode '{mode}'")
+
+
+def _reflink(src, dest):
+    try:
+        import fcntl
+
+        with open(src, "rb") as f_src, open(dest, "wb") as f_dest:
+            fcntl.ioctl(f_dest.fileno(), FICLONE, f_src.fileno())
+        shutil.copymode(src, dest)
+        os.chmod(dest, os.stat(dest).st_mode | 0o200)
+    except (ImportError, OSError):
+        # not supported by this platform or filesystem
+        shutil.copyfile(src, dest)
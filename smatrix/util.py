@@ -0,0 +1,100 @@
+# small helpers shared by several commands
+
+import csv
+import json
+import os
+import tempfile
+from collections import deque
+
+BLOCK_SIZE = 1 << 16
+
+
+def compress_ids(ids):
+    """Collapse ids into sorted (first, last) ranges of consecutive ids"""
+    ranges = []
+    for id in sorted(set(ids)):
+        if ranges and ranges[-1][1] + 1 == id:
+            ranges[-1] = (ranges[-1][0], id)
+        else:
+            ranges.append((id, id))
+    return ranges
+
+
+def parse_ranges(s):
+    """The inverse of format_ranges, as a list of ids"""
+    ids = []
+    for part in s.split(","):
+        first, _, last = part.partition("-")
+        ids += range(int(first), int(last or first) + 1)
+    return ids
+
+
+def format_ranges(ranges):
+    """Compress ranges of ids, e.g. [(0, 99), (205, 205)] as '0-99,205'"""
+    return ",".join(
+        str(first) if first == last else f"{first}-{last}" for first, last in ranges
+    )
+
+
+def iter_lines_backwards(f):
+    """Yield the lines of a binary file (without their newlines), last first,
+    reading backwards a block at a time so that the end is found without reading
+    the whole file"""
+    f.seek(0, os.SEEK_END)
+    position = f.tell()
+    remainder = b""
+
+    while position > 0:
+        size = min(BLOCK_SIZE, position)
+        position -= size
+        f.seek(position)
+
+        lines = (f.read(size) + remainder).split(b"\n")
+        # the first line may be incomplete, unless this is the start of the file
+        remainder = lines.pop(0)
+        yield from reversed(lines)
+
+    yield remainder
+
+
+def map_bounded(pool, fn, items, window):
+    """Like pool.map, but with at most `window` items in flight at once"""
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(fn, *item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def is_jsonl(path):
+    """Whether rows written to `path` should be JSON lines, rather than CSV"""
+    return path is not None and path.endswith((".jsonl", ".ndjson"))
+
+
+def write_rows(out, rows, jsonl=False):
+    """Write rows with differing columns as JSON lines, or as one CSV, without
+    keeping them all
+
+    For CSV, rows are spooled to a temporary file as they arrive, and only the
+    union of their columns is kept, so that the header can be written first.
+    """
+    if jsonl:
+        for row in rows:
+            out.write(json.dumps(row, default=str) + "\n")
+        return
+
+    columns = dict()
+    with tempfile.TemporaryFile("w+") as spool:
+        for row in rows:
+            for k in row:
+                columns.setdefault(k, None)
+            spool.write(json.dumps(row, default=str) + "\n")
+
+        writer = csv.DictWriter(out, fieldnames=list(columns))
+        writer.writeheader()
+
+        spool.seek(0)
+        for line in spool:
+            writer.writerow(json.loads(line))
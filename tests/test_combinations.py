@@ -0,0 +1,112 @@
+import itertools
+
+from smatrix import create
+
+
+def combinations(zip=(), exclude=(), include=()):
+    return {"zip": list(zip), "exclude": list(exclude), "include": list(include)}
+
+
+def states(cfg):
+    return list(create.iter_matrix(cfg))
+
+
+def test_product_order():
+    cfg = {"matrix": {"a": [1, 2], "b": ["x", "y"]}}
+
+    assert states(cfg) == [
+        (0, {"a": 1, "b": "x"}),
+        (1, {"a": 1, "b": "y"}),
+        (2, {"a": 2, "b": "x"}),
+        (3, {"a": 2, "b": "y"}),
+    ]
+    assert create.matrix_size(cfg) == 4
+
+
+def test_zip_exclude_and_include():
+    matrix = {"a": [1, 2, 3], "c": ["p", "q"], "b": ["x", "y", "z"]}
+    cfg = {
+        "matrix": matrix,
+        "combinations": combinations(
+            zip=[["a", "b"]],
+            exclude=[{"a": 2}, {"b": "z", "c": "q"}],
+            include=[{"a": 9, "b": "w", "c": "p"}],
+        ),
+    }
+
+    # the zipped axis comes first, as a is the first variable of the matrix,
+    # and each state still has its variables in the matrix's order
+    assert states(cfg) == [
+        (0, {"a": 1, "c": "p", "b": "x"}),
+        (1, {"a": 1, "c": "q", "b": "x"}),
+        (2, {"a": 3, "c": "p", "b": "z"}),
+        (3, {"a": 9, "b": "w", "c": "p"}),
+    ]
+    # ids don't depend on anything but the config
+    assert states(cfg) == states(cfg)
+
+
+def test_exclude_matches_the_full_product():
+    matrix = {"a": [1, 2, 3], "b": ["x", "y"], "c": [True, False], "d": [4, 5]}
+    rules = [{"b": "y", "d": 4}, {"a": 3}, {"a": 1, "c": True, "d": 5}]
+    cfg = {"matrix": matrix, "combinations": combinations(exclude=rules)}
+
+    # the same as filtering every combination, without pruning branches early
+    expected = [
+        dict(zip(matrix, values))
+        for values in itertools.product(*matrix.values())
+        if not any(create.matches_rule(dict(zip(matrix, values)), r) for r in rules)
+    ]
+    assert states(cfg) == list(enumerate(expected))
+
+
+def test_matrix_size():
+    assert create.matrix_size({"matrix": [{"a": 1}, {"a": 2}]}) == 2
+    assert create.matrix_size({"matrix": iter([{"a": 1}])}) is None
+
+    matrix = {"a": [1, 2, 3], "b": ["x", "y", "z"], "c": ["p", "q"]}
+    cfg = {
+        "matrix": matrix,
+        "combinations": combinations(zip=[["a", "b"]], include=[{"a": 9}]),
+    }
+    assert create.matrix_size(cfg) == 3 * 2 + 1
+    assert create.matrix_size(cfg) == len(states(cfg))
+
+    # excluded combinations can only be counted by going through them
+    cfg["combinations"]["exclude"] = [{"a": 1}]
+    assert create.matrix_size(cfg) is None
+
+
+def test_matches_rule_on_tables():
+    state = {"model": {"label": "big", "size": 10}, "lr": 1}
+
+    # a table is matched by its label
+    assert create.matches_rule(state, {"model": "big"})
+    assert not create.matches_rule(state, {"model": "small"})
+    assert create.matches_rule(state, {"model": "big", "lr": "1"})
+    assert not create.matches_rule(state, {"model": "big", "lr": 2})
+
+    # or by some of its values
+    assert create.matches_rule(state, {"model": {"size": 10}})
+    assert create.matches_rule(state, {"model": {"size": "10", "label": "big"}})
+    assert not create.matches_rule(state, {"model": {"size": 11}})
+    assert not create.matches_rule(state, {"lr": {"size": 1}})
+
+    # without a label, by its first value
+    assert create.matches_rule({"model": {"size": 10, "depth": 2}}, {"model": 10})
+
+
+def test_exclude_tables():
+    small = {"label": "small", "size": 1}
+    big = {"label": "big", "size": 10}
+    cfg = {
+        "matrix": {"model": [small, big], "lr": [1, 2]},
+        "combinations": combinations(
+            exclude=[{"model": "big", "lr": 2}, {"model": {"size": 1}, "lr": 1}]
+        ),
+    }
+
+    assert states(cfg) == [
+        (0, {"model": small, "lr": 2}),
+        (1, {"model": big, "lr": 1}),
+    ]
@@ -0,0 +1,55 @@
+from smatrix import groups
+
+
+def make_cfg(tmp_path, params, matrix):
+    return {
+        "general": {"name": "test", "params": params},
+        "matrix": matrix,
+        "root_dir": tmp_path,
+    }
+
+
+def test_only_matrix_variables_group_instances(tmp_path):
+    matrix = {"threads": [1, 2], "model": [{"label": "big", "mem": "4G"}]}
+    first = {"threads": 1, "model": matrix["model"][0]}
+
+    for params in [
+        "#SBATCH --time=1",
+        "#SBATCH --chdir=$HOME --job-name=${MATRIX_JOB_ID}_$MATRIX_NAME",
+        # a table's values are only visible flattened
+        "#SBATCH --mem=$model",
+    ]:
+        assert not groups.is_grouped(make_cfg(tmp_path, params, matrix), first)
+
+    for params in ["#SBATCH --cpus-per-task=$threads", "#SBATCH --mem=${model_mem}"]:
+        assert groups.is_grouped(make_cfg(tmp_path, params, matrix), first)
+
+
+def test_streamed_matrix_uses_its_first_state(tmp_path):
+    cfg = make_cfg(tmp_path, "#SBATCH --cpus-per-task=$threads", iter([]))
+
+    assert groups.is_grouped(cfg, {"threads": "1"})
+    assert not groups.is_grouped(cfg, {"1": "1"})
+
+
+def test_track_substitutes_only_matrix_variables(tmp_path):
+    params = "#SBATCH --cpus-per-task=$threads --chdir=$HOME --job-name=$MATRIX_JOB_ID"
+    cfg = make_cfg(tmp_path, params, {"threads": [1, 2]})
+    states = [(id, {"threads": threads}) for id, threads in enumerate([1, 2, 1, 1])]
+
+    assert list(groups.track(cfg, states)) == states
+    assert cfg["groups"] == [
+        {
+            "params": "#SBATCH --cpus-per-task=1 --chdir=$HOME --job-name=$MATRIX_JOB_ID",
+            "ids_file": "groups/0.ids",
+            "count": 3,
+            "ids": "0,2-3",
+        },
+        {
+            "params": "#SBATCH --cpus-per-task=2 --chdir=$HOME --job-name=$MATRIX_JOB_ID",
+            "ids_file": "groups/1.ids",
+            "count": 1,
+            "ids": "1",
+        },
+    ]
+    assert groups.group_ids(cfg["groups"][0]["ids"]) == (0, 2, 3)
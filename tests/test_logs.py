@@ -0,0 +1,45 @@
+import io
+import re
+
+import pytest
+
+from smatrix import logs
+from smatrix import util
+
+
+@pytest.fixture(params=[3, 1 << 16])
+def block_size(request, monkeypatch):
+    """Read in tiny blocks too, so that lines are split between them"""
+    monkeypatch.setattr(util, "BLOCK_SIZE", request.param)
+    return request.param
+
+
+@pytest.mark.parametrize(
+    "contents", [b"", b"\n", b"one", b"one\ntwo\n", b"one\n\nthree longer line\nfour"]
+)
+def test_iter_lines_backwards(block_size, contents):
+    lines = list(util.iter_lines_backwards(io.BytesIO(contents)))
+    assert lines == contents.split(b"\n")[::-1]
+
+
+def test_tail_lines(tmp_path, block_size):
+    path = tmp_path / "slurm-1000.out"
+    path.write_bytes(b"first\n\nsecond line\n  \nthird\n\n")
+
+    assert logs.tail_lines(path, 2) == ["second line", "third"]
+    assert logs.tail_lines(path, 5) == ["first", "second line", "third"]
+    assert logs.tail_lines(path, 0) == []
+
+
+def test_grep_lines(tmp_path):
+    path = tmp_path / "slurm-1000.out"
+    path.write_bytes(b"ok\nerror: one\n\nok\nerror: two, error: three\nerror: four")
+
+    assert list(logs.grep_lines(path, re.compile(rb"error"))) == [
+        (2, "error: one"),
+        (5, "error: two, error: three"),
+        (6, "error: four"),
+    ]
+
+    (tmp_path / "empty.out").write_bytes(b"")
+    assert list(logs.grep_lines(tmp_path / "empty.out", re.compile(rb"error"))) == []
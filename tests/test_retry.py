@@ -0,0 +1,234 @@
+import json
+import os
+from argparse import Namespace
+
+import pytest
+
+from smatrix import slurm
+
+JOB_ID = 1000
+RETRY_JOB_ID = 2000
+# the first job ID that the stub sbatch hands out
+NEW_JOB_ID = 3000
+
+
+def sacct_record(job_id, task_id, state, start=0):
+    """One of sacct's records, where a `task_id` of None covers the tasks of
+    the array which haven't started yet"""
+    return {
+        "array": {
+            "job_id": job_id,
+            "task_id": {"set": task_id is not None, "number": task_id or 0},
+        },
+        "state": {"current": [state]},
+        "time": {"start": start},
+    }
+
+
+@pytest.fixture
+def cfg():
+    return {"general": {"pack": 1, "concurrent": 0}, "count": 6}
+
+
+def test_apply_retry_states_splits_segments():
+    segments = [(0, 5, "FAILED", 1), (6, 9, "COMPLETED", 1)]
+    states = {2: ("RUNNING", 2), 3: ("RUNNING", 2), 5: ("COMPLETED", 3)}
+
+    assert slurm.apply_retry_states(segments, states) == [
+        (0, 1, "FAILED", 1),
+        (2, 3, "RUNNING", 2),
+        (4, 4, "FAILED", 1),
+        (5, 5, "COMPLETED", 3),
+        (6, 9, "COMPLETED", 1),
+    ]
+
+
+def test_apply_retry_states_merges_identical_neighbours():
+    segments = [(0, 1, "FAILED", 1), (2, 3, "COMPLETED", 1)]
+    # the retried instance ends up just like the ones after it
+    states = {1: ("COMPLETED", 1)}
+
+    assert slurm.apply_retry_states(segments, states) == [
+        (0, 0, "FAILED", 1),
+        (1, 3, "COMPLETED", 1),
+    ]
+    assert slurm.apply_retry_states(segments, {}) == segments
+
+
+def test_get_retry_states(cfg):
+    retries = [
+        {"job_id": RETRY_JOB_ID, "array_job_id": JOB_ID, "tasks": [1, 2, 4]},
+        {"job_id": RETRY_JOB_ID + 1, "array_job_id": JOB_ID, "tasks": [4]},
+        # sacct doesn't know about this one yet
+        {"job_id": RETRY_JOB_ID + 2, "array_job_id": JOB_ID, "tasks": [5]},
+        # nor the array that it retries
+        {"job_id": RETRY_JOB_ID + 3, "array_job_id": 999, "tasks": [0]},
+    ]
+    data = {
+        "jobs": [
+            sacct_record(RETRY_JOB_ID, 1, "COMPLETED", 5),
+            sacct_record(RETRY_JOB_ID, 4, "FAILED", 5),
+            sacct_record(RETRY_JOB_ID, None, "PENDING"),
+            sacct_record(RETRY_JOB_ID + 1, 4, "RUNNING", 6),
+        ]
+    }
+
+    assert slurm.get_retry_states(cfg, None, [JOB_ID], data, retries) == {
+        1: ("COMPLETED", 5),
+        2: ("PENDING", 0),
+        # the latest retry wins
+        4: ("RUNNING", 6),
+        5: ("UNKNOWN", None),
+    }
+
+
+def test_get_segments_with_retries(cfg):
+    retries = [{"job_id": RETRY_JOB_ID, "array_job_id": JOB_ID, "tasks": [1, 2]}]
+    data = {
+        "jobs": [sacct_record(JOB_ID, id, "FAILED", 1) for id in range(4)]
+        + [
+            sacct_record(RETRY_JOB_ID, 1, "COMPLETED", 2),
+            sacct_record(RETRY_JOB_ID, 2, "COMPLETED", 2),
+        ]
+    }
+
+    assert slurm.get_segments(cfg, None, [JOB_ID], data, retries) == [
+        (0, 0, "FAILED", 1),
+        (1, 2, "COMPLETED", 2),
+        (3, 3, "FAILED", 1),
+        (4, 5, "UNKNOWN", None),
+    ]
+
+
+def test_combine_stages():
+    stage_segments = [
+        ("prep", [(0, 2, "COMPLETED", 1), (3, 3, "FAILED", 1)]),
+        ("run", [(0, 0, "COMPLETED", 2), (1, 2, "RUNNING", 2), (3, 3, "PENDING", 0)]),
+    ]
+
+    # an instance is in its first stage which hasn't completed
+    assert slurm.combine_stages(4, stage_segments) == [
+        (0, 0, "COMPLETED (run)", 2),
+        (1, 2, "RUNNING (run)", 2),
+        (3, 3, "FAILED (prep)", 1),
+    ]
+
+
+@pytest.fixture
+def cluster(tmp_path, monkeypatch):
+    """Stub sacct and sbatch on PATH. sacct prints `sacct.json`, and sbatch logs
+    its arguments and hands out job IDs from NEW_JOB_ID on"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    scripts = {
+        "sacct": f'cat "{tmp_path}/sacct.json"\n',
+        "sbatch": f"""echo "$@" >> "{tmp_path}/sbatch.log"
+job_id=$(cat "{tmp_path}/next_job_id" 2>/dev/null || echo {NEW_JOB_ID})
+echo $((job_id + 1)) > "{tmp_path}/next_job_id"
+echo "Submitted batch job $job_id"
+""",
+    }
+    for name, script in scripts.items():
+        (bin_dir / name).write_text("#!/bin/sh\n" + script)
+        (bin_dir / name).chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("SMATRIX_REGISTRY", str(tmp_path / "registry.jsonl"))
+
+    class Cluster:
+        def accounting(self, records):
+            (tmp_path / "sacct.json").write_text(json.dumps({"jobs": records}))
+
+        def submitted(self):
+            lines = (tmp_path / "sbatch.log").read_text().splitlines()
+            # leave out the path of the executor
+            return [line.rsplit("/", 1)[1] for line in lines], [
+                line.rsplit(" ", 1)[0] for line in lines
+            ]
+
+    return Cluster()
+
+
+@pytest.fixture
+def staged_matrix(tmp_path):
+    """A started matrix of 4 instances, which each run a prep and a run stage"""
+    matrix_path = tmp_path / "matrix"
+    matrix_path.mkdir()
+    arrays = [
+        {
+            "script": f"executor_{stage}.sh",
+            "offset": 0,
+            "tasks": 4,
+            "instances": 4,
+            "stage": stage,
+        }
+        for stage in ["prep", "run"]
+    ]
+    cfg = {
+        "general": {"name": "test", "pack": 1, "concurrent": 0},
+        "count": 4,
+        "stages": ["prep", "run"],
+        "arrays": arrays,
+    }
+    (matrix_path / "matrix_config_snapshot.json").write_text(json.dumps(cfg))
+    slurm.write_job_ids(matrix_path, [JOB_ID, JOB_ID + 1])
+    return matrix_path
+
+
+def retry_args(matrix_path, **kwargs):
+    return Namespace(
+        **{
+            "matrix_path": str(matrix_path),
+            "name": None,
+            "state": None,
+            "mem": None,
+            "time": None,
+            "dry_run": False,
+            **kwargs,
+        }
+    )
+
+
+def test_retry_chains_each_stage_that_instances_restart_from(cluster, staged_matrix):
+    cluster.accounting(
+        [sacct_record(JOB_ID, 0, "COMPLETED")]
+        + [sacct_record(JOB_ID, 1, "FAILED")]
+        + [sacct_record(JOB_ID, id, "COMPLETED") for id in [2, 3]]
+        + [sacct_record(JOB_ID + 1, 0, "COMPLETED")]
+        + [sacct_record(JOB_ID + 1, 1, "CANCELLED")]
+        + [sacct_record(JOB_ID + 1, 2, "TIMEOUT")]
+        + [sacct_record(JOB_ID + 1, 3, "COMPLETED")]
+    )
+
+    assert slurm.retry(retry_args(staged_matrix)) == 0
+
+    # instance 1 reruns both stages, in a chain of their own, and instance 2
+    # only reruns its run stage
+    scripts, commands = cluster.submitted()
+    assert scripts == ["executor_prep.sh", "executor_run.sh", "executor_run.sh"]
+    assert commands == [
+        "--export=ALL,SMATRIX_RETRY=1 --array=1",
+        f"--export=ALL,SMATRIX_RETRY=1 --array=1 --dependency=aftercorr:{NEW_JOB_ID}",
+        "--export=ALL,SMATRIX_RETRY=1 --array=2",
+    ]
+
+    assert slurm.read_retries(staged_matrix) == [
+        {"job_id": NEW_JOB_ID, "array_job_id": JOB_ID, "tasks": [1]},
+        {"job_id": NEW_JOB_ID + 1, "array_job_id": JOB_ID + 1, "tasks": [1]},
+        {"job_id": NEW_JOB_ID + 2, "array_job_id": JOB_ID + 1, "tasks": [2]},
+    ]
+
+
+def test_retry_uses_the_state_of_the_latest_retry(cluster, staged_matrix):
+    cluster.accounting(
+        [sacct_record(JOB_ID, id, "COMPLETED") for id in range(4)]
+        + [sacct_record(JOB_ID + 1, id, "FAILED") for id in range(4)]
+        + [sacct_record(RETRY_JOB_ID, id, "COMPLETED") for id in [0, 1]]
+    )
+    slurm.write_retry(staged_matrix, RETRY_JOB_ID, JOB_ID + 1, [0, 1, 2])
+
+    assert slurm.retry(retry_args(staged_matrix, state=["FAILED,UNKNOWN"])) == 0
+
+    # instance 2's retry hasn't shown up in sacct, and 3 still failed
+    scripts, commands = cluster.submitted()
+    assert scripts == ["executor_run.sh"]
+    assert commands == ["--export=ALL,SMATRIX_RETRY=1 --array=2-3"]
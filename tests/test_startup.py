@@ -0,0 +1,93 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# these are slow to import, and shouldn't be needed just to print the help
+HEAVY_MODULES = {"rich", "schema", "toml"}
+
+
+def run_smatrix(*args, env=None):
+    """Run smatrix with `args`, and return its output and the modules that it
+    imported"""
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            "import sys; sys.argv[0] = 'smatrix'; from smatrix.main import main; main()",
+            *args,
+        ],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        timeout=60,
+        env=env,
+    )
+    assert result.returncode == 0, result.stderr
+
+    # lines look like "import time:   self [us] | cumulative | imported package"
+    modules = set()
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            modules.add(line.rsplit("|", 1)[1].strip())
+    return result.stdout, modules
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ["--help"],
+        ["ps", "--help"],
+        ["create", "--help"],
+        ["logs", "--help"],
+        ["stats", "--help"],
+    ],
+)
+def test_help_skips_heavy_imports(args):
+    output, modules = run_smatrix(*args)
+    assert "usage:" in output
+    assert "smatrix.main" in modules
+    assert not modules & HEAVY_MODULES
+
+
+def test_ps_skips_unused_imports(tmp_path):
+    matrix_path = tmp_path / "matrix"
+    matrix_path.mkdir()
+    (matrix_path / "matrix_config_snapshot.json").write_text(
+        json.dumps({"general": {"name": "test", "pack": 1}, "count": 4})
+    )
+    (matrix_path / "job_id").write_text("1000\n")
+
+    # a stub sacct, which says that every task has finished
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    jobs = [
+        {
+            "array": {"job_id": 1000, "task_id": {"set": True, "number": task_id}},
+            "state": {"current": ["COMPLETED"]},
+            "time": {"start": 0},
+        }
+        for task_id in range(4)
+    ]
+    (tmp_path / "sacct.json").write_text(json.dumps({"jobs": jobs}))
+    sacct = bin_dir / "sacct"
+    sacct.write_text(f'#!/bin/sh\ncat "{tmp_path}/sacct.json"\n')
+    sacct.chmod(0o755)
+
+    env = dict(
+        os.environ,
+        PATH=f"{bin_dir}{os.pathsep}{os.environ['PATH']}",
+        SMATRIX_REGISTRY=str(tmp_path / "registry.jsonl"),
+        COLUMNS="200",
+    )
+    output, modules = run_smatrix("ps", "--matrix-path", str(matrix_path), env=env)
+    assert "COMPLETED" in output
+    # ps only prints a table, so it shouldn't need to validate or watch anything
+    assert not modules & {"schema", "toml", "rich.live"}
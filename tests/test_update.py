@@ -0,0 +1,151 @@
+import json
+import os
+from argparse import Namespace
+
+import pytest
+
+from smatrix import create
+
+CONFIG = """
+[general]
+name = "test"
+root_label = "out"
+instance_label = "{label}"
+concurrent = 2
+params = "#SBATCH --time=1"
+
+[matrix]
+aa = {values}
+
+[symlinks]
+"input" = "data/in_$aa"
+
+[script]
+slurm_exec = "echo $aa"
+"helper.sh" = "{helper}"
+"""
+
+
+@pytest.fixture
+def matrix(tmp_path, monkeypatch):
+    """Creates and updates a matrix in `tmp_path / "out"`, whose `aa` takes each
+    of `values`, and whose instances are labelled by `label`"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("SMATRIX_REGISTRY", str(tmp_path / "registry.jsonl"))
+    monkeypatch.setenv("SMATRIX_CONFIG_CACHE", str(tmp_path / "configs"))
+
+    def load(values, label, helper):
+        # every instance links to an input of its own
+        (tmp_path / "data").mkdir(exist_ok=True)
+        for value in values:
+            (tmp_path / "data" / f"in_{value}").write_text(value)
+
+        path = tmp_path / "matrix.toml"
+        path.write_text(
+            CONFIG.format(values=json.dumps(values), label=label, helper=helper)
+        )
+        return create.load_config(path)
+
+    class Matrix:
+        root = tmp_path / "out"
+
+        def create(self, values, label="$aa", helper="echo helper"):
+            cfg = load(values, label, helper)
+            create.create_from_cfg(Namespace(jobs=1, start=False), cfg)
+
+        def update(self, values, label="$aa", helper="echo helper", jobs=1):
+            cfg = load(values, label, helper)
+            cfg["root_dir"] = self.root
+            cfg["job_dir"] = self.root / "jobs"
+            assert create.update_from_cfg(Namespace(jobs=jobs), cfg) == 0
+            return cfg
+
+        def instance_dir(self, id):
+            return (self.root / "jobs" / str(id)).resolve()
+
+    return Matrix()
+
+
+def test_update_keeps_outputs_of_changed_and_removed_instances(matrix):
+    matrix.create(["x", "y", "z"])
+    for value in ["x", "y", "z"]:
+        (matrix.root / value / "result.txt").write_text(value)
+
+    matrix.update(["x", "w"])
+
+    # y's instance is now w, and z's is gone, but both left their outputs
+    assert matrix.instance_dir(1) == matrix.root / "w"
+    assert not (matrix.root / "jobs" / "2").exists()
+    for value in ["y", "z"]:
+        assert os.listdir(matrix.root / value) == ["result.txt"]
+        assert (matrix.root / value / "result.txt").read_text() == value
+    assert (matrix.root / "x" / "result.txt").read_text() == "x"
+    assert (matrix.root / "x" / "job_run.sh").exists()
+
+
+def test_update_swaps_labels(matrix):
+    matrix.create(["x", "y"])
+    for value in ["x", "y"]:
+        (matrix.root / value / "result.txt").write_text(value)
+
+    matrix.update(["y", "x"], jobs=2)
+
+    for id, value in enumerate(["y", "x"]):
+        dir = matrix.instance_dir(id)
+        assert dir == matrix.root / value
+        assert os.readlink(dir / "input").endswith(f"data/in_{value}")
+        environment = (dir / "job_environment").read_text().split("\0")
+        assert f"aa={value}" in environment
+        assert f"MATRIX_JOB_ID={id}" in environment
+        # the outputs stay in the directory that they were written to
+        assert (dir / "result.txt").read_text() == value
+
+
+def test_update_only_rewrites_changed_scripts(matrix, monkeypatch):
+    matrix.create(["x", "y"])
+
+    written = []
+    monkeypatch.setattr(
+        create, "write_instance", lambda cfg, inst, **kwargs: written.append(inst.id)
+    )
+    matrix.update(["x", "y"], helper="echo changed")
+
+    assert written == []
+    for value in ["x", "y"]:
+        assert (matrix.root / value / "helper.sh").read_text() == "echo changed"
+
+
+def test_update_shrinks_and_grows_the_manifest(matrix):
+    matrix.create(["x", "y", "z"])
+
+    cfg = matrix.update(["x"])
+    entries, scripts = create.read_manifest(cfg)
+    assert sorted(entries) == [0]
+    assert entries[0][1] == "x"
+    assert "job_run.sh" in scripts[1]
+    # nothing was left in y and z, so their directories are gone
+    assert not (matrix.root / "y").exists()
+    assert not (matrix.root / "z").exists()
+    assert os.listdir(matrix.root / "jobs") == ["0"]
+
+    cfg = matrix.update(["x", "y", "z"])
+    entries, scripts = create.read_manifest(cfg)
+    assert sorted(entries) == [0, 1, 2]
+    assert [entries[id][1] for id in range(3)] == ["x", "y", "z"]
+    assert matrix.instance_dir(2) == matrix.root / "z"
+
+
+def test_remove_empty_dirs(tmp_path):
+    (tmp_path / "a" / "b" / "c").mkdir(parents=True)
+    (tmp_path / "a" / "kept").mkdir()
+    (tmp_path / "a" / "kept" / "output").write_text("")
+
+    # b only has empty subdirectories, so it goes, but a still holds an output
+    assert create.remove_empty_dirs(tmp_path, "a/b")
+    assert sorted(os.listdir(tmp_path / "a")) == ["kept"]
+
+    assert not create.remove_empty_dirs(tmp_path, "a/kept")
+    assert (tmp_path / "a" / "kept" / "output").exists()
+
+    # a directory that isn't there has already been removed
+    assert create.remove_empty_dirs(tmp_path, "a/missing")
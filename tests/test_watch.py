@@ -0,0 +1,121 @@
+import json
+import os
+from argparse import Namespace
+
+import pytest
+
+from smatrix import slurm
+
+JOB_ID = 1000
+
+
+def sacct_record(task_id, state):
+    return {
+        "array": {"job_id": JOB_ID, "task_id": {"set": True, "number": task_id}},
+        "state": {"current": [state]},
+        "time": {"start": 0},
+    }
+
+
+@pytest.fixture
+def cluster(tmp_path, monkeypatch):
+    """Stub squeue and sacct on PATH, which log their arguments and print
+    whatever the test puts in `squeue.txt` and `sacct.json`"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for name, output in [("squeue", "squeue.txt"), ("sacct", "sacct.json")]:
+        script = bin_dir / name
+        script.write_text(
+            f'#!/bin/sh\necho "$@" >> "{tmp_path}/{name}.log"\ncat "{tmp_path}/{output}"\n'
+        )
+        script.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    class Cluster:
+        def queue(self, tasks):
+            (tmp_path / "squeue.txt").write_text(
+                "".join(f"{JOB_ID} {task_id} {state}\n" for task_id, state in tasks)
+            )
+
+        def accounting(self, tasks):
+            (tmp_path / "sacct.json").write_text(
+                json.dumps({"jobs": [sacct_record(*task) for task in tasks]})
+            )
+
+        def calls(self, name):
+            try:
+                return (tmp_path / f"{name}.log").read_text().splitlines()
+            except FileNotFoundError:
+                return []
+
+    cluster = Cluster()
+    cluster.queue([])
+    cluster.accounting([])
+    return cluster
+
+
+@pytest.fixture
+def cfg():
+    return {"general": {"pack": 1}, "count": 4}
+
+
+def test_poll_asks_sacct_only_about_tasks_that_left_the_queue(tmp_path, cluster, cfg):
+    states = ["RUNNING", "RUNNING", "PENDING", "COMPLETED"]
+    # task 0 is still running, task 1 has finished, and task 2 has started
+    cluster.queue([(0, "RUNNING"), (2, "RUNNING")])
+    cluster.accounting([(1, "FAILED")])
+
+    assert slurm.poll_states(cfg, tmp_path, [JOB_ID], states)
+    assert states == ["RUNNING", "FAILED", "RUNNING", "COMPLETED"]
+
+    assert cluster.calls("squeue") == [f"-h -r -j {JOB_ID} -o %F %K %T"]
+    assert cluster.calls("sacct") == [f"-j {JOB_ID}_1 --json"]
+
+
+def test_poll_skips_sacct_while_everything_is_queued(tmp_path, cluster, cfg):
+    states = ["PENDING", "RUNNING", "COMPLETED", "FAILED"]
+    cluster.queue([(0, "PENDING"), (1, "RUNNING")])
+
+    assert not slurm.poll_states(cfg, tmp_path, [JOB_ID], states)
+    assert cluster.calls("sacct") == []
+
+
+def test_poll_asks_about_the_whole_matrix_beyond_the_limit(
+    tmp_path, cluster, cfg, monkeypatch
+):
+    monkeypatch.setattr(slurm, "MAX_TARGETED_TASKS", 1)
+    states = ["RUNNING"] * 4
+    cluster.accounting([(id, "COMPLETED") for id in range(4)])
+
+    assert slurm.poll_states(cfg, tmp_path, [JOB_ID], states)
+    assert states == ["COMPLETED"] * 4
+    assert cluster.calls("sacct") == [f"-j {JOB_ID} --json"]
+
+
+def test_watch_cache_round_trip(tmp_path, cfg):
+    states = ["COMPLETED", "COMPLETED", "FAILED", "RUNNING"]
+    slurm.write_watch_cache(tmp_path, [JOB_ID], states)
+
+    assert slurm.read_watch_cache(cfg, tmp_path, [JOB_ID]) == states
+    # the cache is only for the same submission
+    assert slurm.read_watch_cache(cfg, tmp_path, [JOB_ID + 1]) is None
+    assert slurm.read_watch_cache(dict(cfg, count=5), tmp_path, [JOB_ID]) is None
+
+
+def test_watch_resumes_from_cache(tmp_path, cluster, cfg):
+    slurm.write_watch_cache(
+        tmp_path, [JOB_ID], ["COMPLETED", "COMPLETED", "FAILED", "RUNNING"]
+    )
+    cluster.accounting([(3, "COMPLETED")])
+
+    args = Namespace(interval=0, state=None)
+    assert slurm.watch(args, cfg, tmp_path, [JOB_ID]) == 0
+
+    # only the task which was running is looked up, rather than the whole matrix
+    assert cluster.calls("sacct") == [f"-j {JOB_ID}_3 --json"]
+    assert slurm.read_watch_cache(cfg, tmp_path, [JOB_ID]) == [
+        "COMPLETED",
+        "COMPLETED",
+        "FAILED",
+        "COMPLETED",
+    ]